@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+# Compares per-check wall time of one process per check against the daemon + client shim.
+#
+#   python benchmarks/bench_daemon.py -n 50 -- --host localhost -c 10 -w 5 -s 600 -q '*'
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGIN = os.path.join(ROOT, "check_elasticsearch_metrics.py")
+DAEMON = os.path.join(ROOT, "check_elasticsearch_daemon.py")
+CLIENT = os.path.join(ROOT, "check_elasticsearch_client.py")
+
+
+def time_checks(command, count, env=None):
+    timings = []
+
+    for _ in range(count):
+        started = time.perf_counter()
+        subprocess.call(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started)
+
+    return timings
+
+
+def wait_for_socket(path, timeout=10):
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        if time.time() > deadline:
+            raise RuntimeError("daemon did not create {}".format(path))
+        time.sleep(0.05)
+
+
+def report(name, timings):
+    print("{:<20} mean {:8.1f} ms  p50 {:8.1f} ms  max {:8.1f} ms".format(
+        name,
+        statistics.mean(timings) * 1000,
+        statistics.median(timings) * 1000,
+        max(timings) * 1000))
+
+
+def main(argv):
+    arg_parser = argparse.ArgumentParser(description="Benchmark process-per-check against the check daemon")
+    arg_parser.add_argument("-n", "--count", action="store", type=int, default=20, help="checks per mode (default: 20)")
+    arg_parser.add_argument("--socket", action="store", default="/tmp/check_elasticsearch_bench.sock",
+                            help="unix socket for the benchmark daemon")
+    arg_parser.add_argument("check_args", nargs=argparse.REMAINDER, help="check_elasticsearch_metrics.py arguments")
+    args = arg_parser.parse_args(argv)
+
+    check_args = args.check_args[1:] if args.check_args[:1] == ["--"] else args.check_args
+
+    report("process per check", time_checks([sys.executable, PLUGIN] + check_args, args.count))
+
+    daemon = subprocess.Popen([sys.executable, DAEMON, "--socket", args.socket], stderr=subprocess.DEVNULL)
+    try:
+        wait_for_socket(args.socket)
+        env = dict(os.environ, CHECK_ELASTICSEARCH_SOCKET=args.socket)
+        report("daemon + client", time_checks([sys.executable, CLIENT] + check_args, args.count, env=env))
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# Decoding and handling cost of aggregation responses, from raw bytes to the check value.
+#
+#   python benchmarks/bench_decode.py -n 20
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import check_elasticsearch_metrics  # noqa: E402
+
+CHECK_ARGV = ["--host", "bench", "-c", "100", "-w", "50", "-s", "600", "-q", "*",
+              "--aggregation_name", "levels",
+              "--aggregation_type", "significant_terms",
+              "--aggregation_field", "level.raw",
+              "--aggregation_result_bucket_key", "key-1",
+              "--aggregation_result_type", "percentage"]
+
+
+def build_response(bucket_count):
+    buckets = [{"key": "key-{}".format(i), "doc_count": bucket_count - i, "score": 1.0, "bg_count": 10 * (bucket_count - i)}
+               for i in range(bucket_count)]
+    response = {"took": 12, "timed_out": False, "_shards": {"total": 5, "successful": 5, "failed": 0},
+                "hits": {"total": bucket_count * bucket_count, "max_score": 0.0, "hits": []},
+                "aggregations": {"levels": {"doc_count": bucket_count * bucket_count, "bg_count": 100 * bucket_count,
+                                            "buckets": buckets}}}
+
+    return json.dumps(response).encode("utf-8")
+
+
+def decoders():
+    from elasticsearch_dsl import Search
+    from elasticsearch_dsl.response import Response
+
+    yield "elasticsearch_dsl Response", lambda data: Response(Search(), json.loads(data.decode("utf-8")))
+    yield "json", json.loads
+
+    try:
+        import orjson
+    except ImportError:
+        return
+    yield "orjson", orjson.loads
+
+
+def bench(args, decode, data, count):
+    timings = []
+
+    for _ in range(count):
+        started = time.perf_counter()
+        check_elasticsearch_metrics.handle_elastic_response(args, decode(data))
+        timings.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    check_elasticsearch_metrics.handle_elastic_response(args, decode(data))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return sorted(timings)[len(timings) // 2], peak
+
+
+def main(argv):
+    arg_parser = argparse.ArgumentParser(description="Benchmark aggregation response decoding and handling")
+    arg_parser.add_argument("-n", "--count", action="store", type=int, default=20, help="runs per scenario (default: 20)")
+    arg_parser.add_argument("--buckets", action="store", type=int, nargs="+", default=[10, 1000, 100000],
+                            help="bucket counts of the responses (default: 10 1000 100000)")
+    args = arg_parser.parse_args(argv)
+
+    check_args = check_elasticsearch_metrics.parse_args(CHECK_ARGV)
+
+    for bucket_count in args.buckets:
+        data = build_response(bucket_count)
+        for name, decode in decoders():
+            median, peak = bench(check_args, decode, data, args.count)
+            print("{:>7} buckets {:<28} p50 {:10.3f} ms  peak memory {:8.2f} MiB".format(
+                bucket_count, name, median * 1000, peak / 1024.0 / 1024.0))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# End-to-end check latency and memory against the in-process stub elasticsearch, no cluster needed.
+#
+#   python benchmarks/bench_end_to_end.py -n 100 --latency_ms 2
+
+import os
+import sys
+import time
+import argparse
+import logging
+import resource
+import tracemalloc
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import check_elasticsearch_metrics  # noqa: E402
+from tests.stub_elasticsearch import StubElasticsearch  # noqa: E402
+
+PLUGIN = os.path.join(ROOT, "check_elasticsearch_metrics.py")
+
+AGGREGATION_ARGS = ["--aggregation_name", "levels",
+                    "--aggregation_type", "significant_terms",
+                    "--aggregation_field", "level.raw",
+                    "--aggregation_result_bucket_key", "key-1"]
+
+
+def percentile(timings, percent):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(round(percent / 100.0 * (len(timings) - 1))))]
+
+
+def check_argv(es, extra_argv):
+    return ["--host", es.host, "--port", str(es.port), "-c", "100", "-w", "50", "-s", "600", "-q", "*",
+            "--index_cache_ttl", "0"] + extra_argv
+
+
+def bench_cold_start(es, count, extra_argv):
+    timings = []
+
+    for _ in range(count):
+        started = time.perf_counter()
+        subprocess.call([sys.executable, PLUGIN] + check_argv(es, extra_argv),
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started)
+
+    # ru_maxrss is in kilobytes on linux, the largest child so far
+    return timings, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def bench_warm(es, count, extra_argv):
+    args = check_elasticsearch_metrics.parse_args(check_argv(es, extra_argv))
+    client = check_elasticsearch_metrics.create_client(args.host, args.port)
+    check_elasticsearch_metrics.run_check(args, client)
+
+    timings = []
+    tracemalloc.start()
+    for _ in range(count):
+        started = time.perf_counter()
+        check_elasticsearch_metrics.run_check(args, client)
+        timings.append(time.perf_counter() - started)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return timings, peak
+
+
+def report(name, timings, peak_memory):
+    print("{:<28} p50 {:8.2f} ms  p99 {:8.2f} ms  peak memory {:8.1f} MiB".format(
+        name,
+        percentile(timings, 50) * 1000,
+        percentile(timings, 99) * 1000,
+        peak_memory / 1024.0 / 1024.0))
+
+
+def main(argv):
+    arg_parser = argparse.ArgumentParser(description="Benchmark complete checks against a stub elasticsearch")
+    arg_parser.add_argument("-n", "--count", action="store", type=int, default=50, help="checks per scenario (default: 50)")
+    arg_parser.add_argument("--cold_count", action="store", type=int, default=10,
+                            help="checks for the process per check scenario (default: 10)")
+    arg_parser.add_argument("--latency_ms", action="store", type=float, default=0, help="stub response latency")
+    arg_parser.add_argument("--buckets", action="store", type=int, default=10000,
+                            help="buckets in the large significant_terms scenario (default: 10000)")
+    arg_parser.add_argument("--indices", action="store", type=int, default=60,
+                            help="indices in the many indices scenario (default: 60)")
+    args = arg_parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    scenarios = (
+        ("cold start", bench_cold_start, args.cold_count, 10, []),
+        ("warm client", bench_warm, args.count, 10, []),
+        ("warm client, aggregation", bench_warm, args.count, 10, AGGREGATION_ARGS),
+        ("large significant_terms", bench_warm, args.count, args.buckets, AGGREGATION_ARGS),
+        ("many indices", bench_warm, args.count, 10, ["-i", str(args.indices)]),
+    )
+
+    for name, bench, count, bucket_count, extra_argv in scenarios:
+        with StubElasticsearch(bucket_count=bucket_count, latency=args.latency_ms / 1000.0) as es:
+            timings, peak_memory = bench(es, count, extra_argv)
+        report(name, timings, peak_memory)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
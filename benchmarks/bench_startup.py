@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+# Import time and one-shot start up cost of the plugin, for the elasticsearch-py and the --fast_http paths.
+#
+#   python benchmarks/bench_startup.py -n 20
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tests.stub_elasticsearch import StubElasticsearch  # noqa: E402
+
+PLUGIN = os.path.join(ROOT, "check_elasticsearch_metrics.py")
+
+
+def import_time(module):
+    # cumulative microseconds reported by -X importtime for the top level module
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+                            cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE).stderr.decode("utf-8")
+
+    for line in output.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000.0
+
+    return None
+
+
+def time_runs(argv, count):
+    timings = []
+
+    for _ in range(count):
+        started = time.perf_counter()
+        subprocess.call([sys.executable, PLUGIN] + argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started)
+
+    return sorted(timings)[len(timings) // 2]
+
+
+def main(argv):
+    arg_parser = argparse.ArgumentParser(description="Benchmark plugin import time and start up")
+    arg_parser.add_argument("-n", "--count", action="store", type=int, default=10, help="runs per scenario (default: 10)")
+    args = arg_parser.parse_args(argv)
+
+    for module in ("check_elasticsearch_metrics", "elasticsearch", "elasticsearch_dsl"):
+        print("{:<40} import {:8.1f} ms".format(module, import_time(module)))
+
+    with StubElasticsearch() as es:
+        check_argv = ["--host", es.host, "--port", str(es.port), "-c", "100", "-w", "50", "-s", "600", "-q", "*"]
+
+        for name, scenario_argv in (("--version", ["--version"]),
+                                    ("argument error", ["--host", es.host]),
+                                    ("check, elasticsearch-py", check_argv),
+                                    ("check, --fast_http", check_argv + ["--fast_http"])):
+            print("{:<40} p50    {:8.1f} ms".format(name, time_runs(scenario_argv, args.count) * 1000))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+from urllib.parse import quote, urlencode
+
+import check_elasticsearch_metrics
+from check_elasticsearch_metrics import NagiosReturnCodes, QueryError, BreakerOpen
+from check_elasticsearch_batch import load_definitions, format_passive_result
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args(argv):
+    arg_parser = argparse.ArgumentParser(description="Runs many check_elasticsearch_metrics checks concurrently against "
+                                                     "one or more clusters and writes Nagios passive check results "
+                                                     "as soon as each check finishes",
+                                         formatter_class=argparse.RawDescriptionHelpFormatter,
+                                         epilog="Check definitions use the check_elasticsearch_batch.py format.\n"
+                                                "Arguments after the options are prepended to every check.\n")
+
+    arg_parser.add_argument("-f", "--definitions", action="store", required=True, help="check definitions file")
+    arg_parser.add_argument("--command_file", action="store",
+                            help="nagios/icinga external command file to write results to (default: stdout)")
+    arg_parser.add_argument("--max_connections", action="store", type=int, default=4,
+                            help="concurrent requests, and open connections, per elasticsearch host (default: 4)")
+    arg_parser.add_argument("--debug", action="store_true", default=False, help="print debug messages")
+    arg_parser.add_argument("--version", action="version",
+                            version='%(prog)s {version}'.format(version=check_elasticsearch_metrics.version))
+
+    return arg_parser.parse_known_args(argv)
+
+
+class ConnectionDropped(EOFError):
+    pass
+
+
+class AsyncHTTPClient:
+    """
+    Keep-alive HTTP/1.1 connections to one elasticsearch host, at most max_connections requests in flight
+    """
+
+    def __init__(self, host, port, max_connections=4):
+        self.host = host
+        self.port = port
+        self.semaphore = asyncio.Semaphore(max_connections)
+        self.idle = []
+
+    async def perform_request(self, method, path, params=None, body=None, timeout=None):
+        url = quote(path, safe="/,*-_.")
+        if params:
+            url = "{}?{}".format(url, urlencode(dict((k, str(v).lower() if isinstance(v, bool) else v)
+                                                     for k, v in params.items())))
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+
+        async with self.semaphore:
+            try:
+                status, response = await asyncio.wait_for(self.send(method, url, data), timeout)
+            except (OSError, EOFError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                raise QueryError("{} {}: {}".format(method, url, str(e) or type(e).__name__))
+
+        if status >= 300:
+            raise QueryError("{} {}: {} {}".format(method, url, status, response.decode("utf-8", "replace")),
+                             status_code=status)
+
+        return check_elasticsearch_metrics.json_loads(response)
+
+    async def send(self, method, url, data):
+        if self.idle:
+            reader, writer = self.idle.pop()
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+
+        try:
+            return await self.exchange(method, url, data, reader, writer)
+        except (ConnectionDropped, ConnectionResetError):
+            # most likely a kept alive connection elasticsearch closed in the meantime, retry once on a new one
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            return await self.exchange(method, url, data, reader, writer)
+
+    async def exchange(self, method, url, data, reader, writer):
+        try:
+            writer.write("{} {} HTTP/1.1\r\nHost: {}:{}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n"
+                         .format(method, url, self.host, self.port, len(data)).encode("latin-1") + data)
+            await writer.drain()
+
+            status_line = (await reader.readline()).split()
+            if len(status_line) < 2 or not status_line[0].startswith(b"HTTP/") or not status_line[1].isdigit():
+                raise ConnectionDropped("no HTTP status line: {!r}".format(b" ".join(status_line)))
+            status = int(status_line[1])
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            if headers.get("transfer-encoding", "").lower() == "chunked":
+                chunks = []
+                while True:
+                    size = int((await reader.readline()).split(b";")[0], 16)
+                    chunk = await reader.readexactly(size + 2)
+                    if size == 0:
+                        break
+                    chunks.append(chunk[:-2])
+                response = b"".join(chunks)
+            else:
+                response = await reader.readexactly(int(headers.get("content-length", 0)))
+        except BaseException:
+            writer.close()
+            raise
+
+        if headers.get("connection", "").lower() == "close":
+            writer.close()
+        else:
+            self.idle.append((reader, writer))
+
+        return status, response
+
+    async def search(self, index, body, request_timeout=None, **params):
+        return await self.perform_request("POST", "/{}/_search".format(index), params, body, timeout=request_timeout)
+
+    async def search_template(self, index, body, request_timeout=None, **params):
+        return await self.perform_request("POST", "/{}/_search/template".format(index), params, body,
+                                          timeout=request_timeout)
+
+    def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+
+class LoopClient:
+    """
+    Blocking calls through an AsyncHTTPClient for code running on an executor thread, the requests run on the loop
+    """
+
+    def __init__(self, client, loop):
+        self.client = client
+        self.loop = loop
+        self.cat = check_elasticsearch_metrics.HTTPCatClient(self)
+
+    def perform_request(self, method, path, params=None, body=None):
+        return asyncio.run_coroutine_threadsafe(self.client.perform_request(method, path, params, body), self.loop).result()
+
+
+async def run_check(args, client):
+    loop = asyncio.get_running_loop()
+
+    if args.incremental or args.baseline or args.aggregation_type == "composite":
+        # the incremental and baseline caches and composite paging are synchronous, run them on a thread with the stdlib client,
+        # its one request at a time takes one of the host's --max_connections
+        http_client = check_elasticsearch_metrics.HTTPClient(args.host, args.port,
+                                                             timeout=args.budget_ms / 1000.0 if args.budget_ms else None)
+        async with client.semaphore:
+            return await loop.run_in_executor(None, check_elasticsearch_metrics.run_check, args, http_client)
+
+    def run(function, *function_args):
+        # the index, result, circuit breaker and last value caches are files and locks shared with other checks,
+        # only the search itself runs on the loop
+        return loop.run_in_executor(None, function, *function_args)
+
+    def record(response=None, error=None, cache_path=None):
+        check_elasticsearch_metrics.after_request(args, response, error)
+        if cache_path:
+            check_elasticsearch_metrics.write_result_cache(args, cache_path, response)
+
+    try:
+        index, body, params, cache_path, response = await run(check_elasticsearch_metrics.prepare_search,
+                                                              args, LoopClient(client, loop))
+
+        if response is None:
+            await run(check_elasticsearch_metrics.before_request, args)
+
+            search = client.search_template if args.template else client.search
+            try:
+                response = await search(index=index, body=body, **params)
+            except QueryError as e:
+                await run(record, None, e)
+                raise
+            await run(record, response, None, cache_path)
+
+        return await run(check_elasticsearch_metrics.evaluate_response, args, response)
+    except BreakerOpen:
+        return await run(check_elasticsearch_metrics.breaker_open, args)
+    except QueryError as e:
+        return await run(check_elasticsearch_metrics.check_failed, args, e)
+
+
+async def run_checks(definitions, common_argv=(), max_connections=4):
+    """
+    Yields (definition, alert_status, output) for every definition, in the order the checks finish
+    """
+    clients = {}
+
+    async def run_definition(definition):
+        try:
+            args = check_elasticsearch_metrics.parse_args(list(common_argv) + definition.argv)
+        except SystemExit:
+            return definition, NagiosReturnCodes.UNKNOWN.value, "Invalid check arguments: {}".format(" ".join(definition.argv))
+
+        if args.store_template or args.profile:
+            return definition, NagiosReturnCodes.UNKNOWN.value, "--store_template and --profile are not checks, " \
+                                                                "run them with check_elasticsearch_metrics.py"
+
+        if (args.host, args.port) not in clients:
+            clients[(args.host, args.port)] = AsyncHTTPClient(args.host, args.port, max_connections=max_connections)
+
+        try:
+            alert_status, output = await run_check(args, clients[(args.host, args.port)])
+        except Exception as e:
+            # one broken check must not stop the others
+            logger.exception("Check {} on {} failed".format(definition.service_description, definition.host_name))
+            return definition, NagiosReturnCodes.UNKNOWN.value, "Check failed: {}".format(str(e) or type(e).__name__)
+
+        return definition, alert_status, output
+
+    try:
+        for future in asyncio.as_completed([run_definition(definition) for definition in definitions]):
+            yield await future
+    finally:
+        for client in clients.values():
+            client.close()
+
+
+async def write_results(definitions, common_argv, max_connections, out):
+    async for definition, alert_status, output in run_checks(definitions, common_argv, max_connections):
+        out.write(format_passive_result(definition, alert_status, output, time.time()))
+        out.flush()
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+
+    args, common_argv = parse_args(argv)
+    if common_argv[:1] == ["--"]:
+        common_argv = common_argv[1:]
+
+    if args.debug:
+        logging.getLogger().setLevel(level=logging.DEBUG)
+
+    definitions = load_definitions(args.definitions)
+
+    if args.command_file:
+        with open(args.command_file, "a") as out:
+            asyncio.run(write_results(definitions, common_argv, args.max_connections, out))
+    else:
+        asyncio.run(write_results(definitions, common_argv, args.max_connections, sys.stdout))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
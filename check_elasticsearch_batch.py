@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+
+import sys
+import time
+import shlex
+import argparse
+import logging
+from collections import OrderedDict, namedtuple
+
+from elasticsearch import exceptions
+from elasticsearch_dsl import MultiSearch
+
+import check_elasticsearch_metrics
+from check_elasticsearch_metrics import NagiosReturnCodes
+
+logger = logging.getLogger(__name__)
+
+CheckDefinition = namedtuple("CheckDefinition", ("host_name", "service_description", "argv"))
+
+
+def parse_args(argv):
+    arg_parser = argparse.ArgumentParser(description="Runs many check_elasticsearch_metrics checks with one _msearch "
+                                                     "request per cluster and writes them as Nagios passive check results",
+                                         formatter_class=argparse.RawDescriptionHelpFormatter,
+                                         epilog="Check definitions file, one check per line:\n"
+                                                "\t<host_name>;<service_description>;<check_elasticsearch_metrics.py arguments>\n"
+                                                "or, for *.yml / *.yaml files, a list of mappings with the keys\n"
+                                                "\thost_name, service_description, args\n"
+                                                "Arguments after the batch options are prepended to every check.\n")
+
+    arg_parser.add_argument("-f", "--definitions", action="store", required=True, help="check definitions file")
+    arg_parser.add_argument("--command_file", action="store",
+                            help="nagios/icinga external command file to write results to (default: stdout)")
+    arg_parser.add_argument("--debug", action="store_true", default=False, help="print debug messages")
+    arg_parser.add_argument("--version", action="version",
+                            version='%(prog)s {version}'.format(version=check_elasticsearch_metrics.version))
+
+    return arg_parser.parse_known_args(argv)
+
+
+def load_definitions(path):
+    definitions = []
+
+    if path.endswith((".yml", ".yaml")):
+        import yaml
+
+        with open(path) as f:
+            for item in yaml.safe_load(f) or []:
+                argv = item["args"]
+                if not isinstance(argv, list):
+                    argv = shlex.split(argv)
+                definitions.append(CheckDefinition(item["host_name"], item["service_description"], list(map(str, argv))))
+
+        return definitions
+
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            host_name, service_description, argv = line.split(";", 2)
+            definitions.append(CheckDefinition(host_name, service_description, shlex.split(argv)))
+
+    return definitions
+
+
+def run_batch(definitions, common_argv=(), get_client=check_elasticsearch_metrics.create_client):
+    results = [None] * len(definitions)
+    clusters = OrderedDict()
+
+    for i, definition in enumerate(definitions):
+        try:
+            args = check_elasticsearch_metrics.parse_args(list(common_argv) + definition.argv)
+        except SystemExit:
+            results[i] = (NagiosReturnCodes.UNKNOWN.value, "Invalid check arguments: {}".format(" ".join(definition.argv)))
+            continue
+
+        if args.store_template or args.profile:
+            results[i] = (NagiosReturnCodes.UNKNOWN.value, "--store_template and --profile are not checks, "
+                                                           "run them with check_elasticsearch_metrics.py")
+            continue
+
+        if check_elasticsearch_metrics.needs_raw_body(args) or args.baseline or args.incremental or args.template:
+            # composite aggregations are paged with one search per page, elasticsearch_dsl can't build
+            # diversified_sampler searches, baselines have their own _msearch, incremental checks merge
+            # their response with cached intervals and templates are searched through _search/template,
+            # they can't share this one
+            results[i] = check_elasticsearch_metrics.run_check(args, get_client(args.host, args.port))
+            continue
+
+        clusters.setdefault((args.host, args.port), []).append((i, args))
+
+    for (host, port), checks in clusters.items():
+        client = get_client(host, port)
+
+        ms = MultiSearch(using=client)
+        searches = []
+        for i, args in checks:
+            try:
+                # missing indices are pruned through _cat/indices, which fails like the search itself
+                ms = ms.add(check_elasticsearch_metrics.build_search(args, client))
+            except check_elasticsearch_metrics.BreakerOpen:
+                results[i] = check_elasticsearch_metrics.breaker_open(args)
+                continue
+            except check_elasticsearch_metrics.query_errors() as e:
+                results[i] = check_elasticsearch_metrics.check_failed(args, e)
+                continue
+            searches.append((i, args))
+        checks = searches
+
+        if not checks:
+            continue
+
+        try:
+            responses = ms.execute(raise_on_error=False)
+        except exceptions.ElasticsearchException as e:
+            logger.error("Got elasticsearch exception: {}".format(e))
+            for i, _ in checks:
+                results[i] = (NagiosReturnCodes.UNKNOWN.value, "Got elasticsearch exception: {}".format(e))
+            continue
+
+        for (i, args), response in zip(checks, responses):
+            if response is None:
+                results[i] = (NagiosReturnCodes.UNKNOWN.value, "Elasticsearch returned an error for this search")
+            else:
+                results[i] = check_elasticsearch_metrics.evaluate_response(args, response)
+
+    return [(definition, alert_status, output) for definition, (alert_status, output) in zip(definitions, results)]
+
+
+def format_passive_result(definition, alert_status, output, timestamp):
+    return "[{timestamp}] PROCESS_SERVICE_CHECK_RESULT;{host_name};{service_description};{alert_status};{output}\n" \
+        .format(timestamp=int(timestamp),
+                host_name=definition.host_name,
+                service_description=definition.service_description,
+                alert_status=alert_status,
+                output=output.replace("\n", " "))
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+
+    args, common_argv = parse_args(argv)
+    if common_argv[:1] == ["--"]:
+        common_argv = common_argv[1:]
+
+    if args.debug:
+        logging.getLogger().setLevel(level=logging.DEBUG)
+
+    results = run_batch(load_definitions(args.definitions), common_argv)
+
+    now = time.time()
+    lines = [format_passive_result(definition, alert_status, output, now) for definition, alert_status, output in results]
+
+    if args.command_file:
+        # the command file is a fifo read by nagios/icinga, keep each write small and line oriented
+        with open(args.command_file, "a") as f:
+            for line in lines:
+                f.write(line)
+                f.flush()
+    else:
+        sys.stdout.writelines(lines)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
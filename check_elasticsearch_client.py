@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+# Drop-in replacement for check_elasticsearch_metrics.py that hands the check to a running
+# check_elasticsearch_daemon.py. Only stdlib modules are imported to keep every run cheap.
+
+import os
+import sys
+import json
+import socket
+
+DEFAULT_SOCKET = "/tmp/check_elasticsearch_metrics.sock"
+UNKNOWN = 3
+
+
+def request_check(socket_path, argv, timeout=None):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps({"argv": argv}).encode("utf-8") + b"\n")
+
+        with sock.makefile("rb") as f:
+            response = json.loads(f.readline().decode("utf-8"))
+    finally:
+        sock.close()
+
+    return response["status"], response["output"]
+
+
+def main(argv):
+    socket_path = os.environ.get("CHECK_ELASTICSEARCH_SOCKET", DEFAULT_SOCKET)
+
+    try:
+        alert_status, output = request_check(socket_path, argv)
+    except (socket.error, OSError):
+        # no daemon listening, run the check in this process instead
+        plugin = os.path.join(os.path.dirname(os.path.abspath(__file__)), "check_elasticsearch_metrics.py")
+        os.execv(sys.executable, [sys.executable, plugin] + argv)
+    except (ValueError, KeyError) as e:
+        alert_status, output = UNKNOWN, "Bad response from check daemon: {}".format(e)
+
+    if output:
+        print(output)
+    sys.exit(alert_status)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
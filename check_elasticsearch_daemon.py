@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+
+import os
+import sys
+import json
+import signal
+import argparse
+import logging
+import threading
+import contextlib
+import socketserver
+from io import StringIO
+
+import check_elasticsearch_metrics
+from check_elasticsearch_metrics import NagiosReturnCodes
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = "/tmp/check_elasticsearch_metrics.sock"
+
+
+def parse_args(argv):
+    arg_parser = argparse.ArgumentParser(description="Runs check_elasticsearch_metrics checks sent by "
+                                                     "check_elasticsearch_client.py over a unix socket, "
+                                                     "reusing keep-alive connections to elasticsearch")
+
+    arg_parser.add_argument("--socket", action="store", default=DEFAULT_SOCKET,
+                            help="unix socket to listen on (default: %(default)s)")
+    arg_parser.add_argument("--cache_dir", action="store", default=check_elasticsearch_metrics.DEFAULT_CACHE_DIR,
+                            help="directory for the local caches of every check, clients can't set it "
+                                 "(default: %(default)s)")
+    arg_parser.add_argument("--pool_size", action="store", type=int, default=10,
+                            help="connections kept open per elasticsearch host (default: 10)")
+    arg_parser.add_argument("--debug", action="store_true", default=False, help="print debug messages")
+    arg_parser.add_argument("--version", action="version",
+                            version='%(prog)s {version}'.format(version=check_elasticsearch_metrics.version))
+
+    return arg_parser.parse_args(argv)
+
+
+class CheckRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            alert_status, output = self.server.run(request["argv"])
+        except (ValueError, KeyError) as e:
+            alert_status, output = NagiosReturnCodes.UNKNOWN.value, "Bad request to check daemon: {}".format(e)
+
+        self.wfile.write(json.dumps({"status": alert_status, "output": output}).encode("utf-8") + b"\n")
+
+
+class CheckServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, pool_size=10, cache_dir=check_elasticsearch_metrics.DEFAULT_CACHE_DIR):
+        self.pool_size = pool_size
+        self.cache_dir = cache_dir
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        # argparse reports errors by printing and exiting, the streams are swapped one check at a time
+        self.parse_lock = threading.Lock()
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        socketserver.UnixStreamServer.__init__(self, socket_path, CheckRequestHandler)
+
+    def server_bind(self):
+        # checks run with the daemon's permissions, only its own user may send them
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+    def get_client(self, host, port):
+        with self.clients_lock:
+            if (host, port) not in self.clients:
+                self.clients[(host, port)] = check_elasticsearch_metrics.create_client(host, port, maxsize=self.pool_size)
+
+            return self.clients[(host, port)]
+
+    def parse_check_args(self, argv):
+        out = StringIO()
+
+        with self.parse_lock, contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+            try:
+                return check_elasticsearch_metrics.parse_args(argv), None
+            except SystemExit as e:
+                return None, (e.code, out.getvalue().strip())
+
+    def run(self, argv):
+        # the daemon's --cache_dir comes first, a different one means the client tried to set it
+        args, error = self.parse_check_args(["--cache_dir", self.cache_dir] + list(argv))
+        if error:
+            return error
+
+        if args.cache_dir != self.cache_dir:
+            return NagiosReturnCodes.UNKNOWN.value, "--cache_dir can't be set by check daemon clients"
+
+        client = self.get_client(args.host, args.port)
+
+        if args.store_template:
+            return check_elasticsearch_metrics.store_template(args, client)
+
+        if args.profile:
+            return check_elasticsearch_metrics.run_profile(args, client)
+
+        return check_elasticsearch_metrics.run_check(args, client)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+
+    args = parse_args(argv)
+
+    if args.debug:
+        logging.getLogger().setLevel(level=logging.DEBUG)
+
+    server = CheckServer(args.socket, pool_size=args.pool_size, cache_dir=args.cache_dir)
+
+    def shutdown(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+
+    logger.info("Listening on {}".format(args.socket))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,22 +1,54 @@
 #!/usr/bin/env python
 
 
+import os
 import sys
+import copy
+import json
+import time
+import fcntl
+import random
+import hashlib
 import argparse
 import logging
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-from elasticsearch import Elasticsearch, exceptions
-from elasticsearch_dsl import Search, A
-
 from enum import Enum
 
-logging.basicConfig(level=logging.INFO)
+try:
+    # optional, decodes large aggregation responses several times faster
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# elasticsearch and elasticsearch_dsl are imported where they are used, --version,
+# argument errors and --fast_http checks never need them
+
+module_loaded = time.perf_counter()
 
 logger = logging.getLogger(__name__)
 
 version = "0.1"
 
+INCREMENTAL_AGGREGATION = "incremental"
+SAMPLE_AGGREGATION = "sample"
+
+# seconds between the current window and each --baseline window, previous is the window length
+BASELINE_OFFSETS = OrderedDict([("previous", None), ("yesterday", 86400), ("last_week", 7 * 86400)])
+ROUNDING_SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "check_elasticsearch_metrics")
+
+# seconds a half-open circuit breaker waits for its probe before letting another check probe
+BREAKER_PROBE_TIMEOUT = 60
+
+# aggregations computing values from a numeric field instead of counting documents
+METRIC_AGGREGATIONS = ("avg", "max", "sum", "percentiles", "stats")
+STATS_VALUES = ("count", "min", "max", "avg", "sum")
+
 
 class NagiosReturnCodes(Enum):
     OK = 0
@@ -25,6 +57,30 @@ class NagiosReturnCodes(Enum):
     UNKNOWN = 3
 
 
+def startup_time():
+    # seconds between the process start and this module being imported (linux only)
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+    process_age = uptime - start_ticks / float(os.sysconf("SC_CLK_TCK"))
+    return max(0.0, process_age - (time.perf_counter() - module_loaded))
+
+
+@contextmanager
+def timed(timings, phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0) + time.perf_counter() - started
+
+
 def parse_args(argv):
     arg_parser = argparse.ArgumentParser(description="Obtains metrics from elasticsearch to power Icinga alerts",
                                          formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -37,25 +93,120 @@ def parse_args(argv):
     # required options
     arg_parser.add_argument("-c", "--critical", action="store", type=float, required=True, help="critical threshold")
     arg_parser.add_argument("--host", action="store", default="localhost", required=True, help="elasticsearch host (default: localhost)")
-    arg_parser.add_argument("-i", "--indices_count", action="store", type=int, default=2,
-                            help="the number of indices to go back through (default: 2)")
+    arg_parser.add_argument("-i", "--indices_count", action="store", type=int,
+                            help="the number of daily indices to go back through "
+                                 "(default: the indices covering --seconds according to --index_pattern)")
     arg_parser.add_argument("--index_prefix", action="store", default="logstash", help="index prefix (default: logstash")
     arg_parser.add_argument("-n", "--index_pattern", action="store", default="{prefix}-{yyyy}.{mm}.{dd}",
-                            help="the pattern expects months and years and can take a prefix and days, e.g: metrics-{yyyy}.{mm}")
+                            help="the pattern expects months and years and can take a prefix, days and hours, e.g: metrics-{yyyy}.{mm}")
     arg_parser.add_argument("-s", "--seconds", action="store", type=int, required=True, help="number of seconds from now to check")
     arg_parser.add_argument("-q", "--query", action="store", required=True, help="the query to run in elasticsearch")
     arg_parser.add_argument("-w", "--warning", action="store", type=float, required=True, help="warning threshold")
 
     # optional options
     arg_parser.add_argument("--aggregation_name", action="store", help="aggregation name")
-    arg_parser.add_argument("--aggregation_type", action="store", choices=("significant_terms",), help="aggregation type")
+    arg_parser.add_argument("--aggregation_type", action="store", choices=("significant_terms", "terms", "filters", "composite") + METRIC_AGGREGATIONS,
+                            help="aggregation type, terms and filters only fetch --aggregation_result_bucket_key buckets when given "
+                                 "and count percentages against all matching documents; composite pages through every "
+                                 "bucket of high cardinality fields (elasticsearch >= 6.1) and, without bucket keys, "
+                                 "reads the largest one; avg, max, sum, percentiles and stats compare the value computed "
+                                 "from a numeric field, the bucket keys are the percents (e.g. 99) or the stats "
+                                 "(count, min, max, avg, sum) to read")
     arg_parser.add_argument("--aggregation_field", action="store", help="the name of the field to aggregate")
     arg_parser.add_argument("--aggregation_result_bucket_key", action="append", help="specify aggregation bucket keys (repeatable argument)")
     arg_parser.add_argument("--aggregation_result_type", action="store", choices=("count", "percentage"), default="count",
                             help="aggregation result type (default: count)")
+    arg_parser.add_argument("--composite_page_size", action="store", type=int, default=1000,
+                            help="buckets per composite aggregation request (default: 1000)")
+    arg_parser.add_argument("--sample_size", action="store", type=int,
+                            help="aggregate a sample of at most this many documents per shard and scale counts to all "
+                                 "matching documents, which bounds the cost of aggregations on very large indices; "
+                                 "percentages are estimated from the sample")
+    arg_parser.add_argument("--sample_diversify_field", action="store",
+                            help="take at most one document per value of this field into the --sample_size sample "
+                                 "(a diversified_sampler)")
+    arg_parser.add_argument("--per_bucket", action="store_true",
+                            help="compare every bucket of the aggregation (or every --aggregation_result_bucket_key) "
+                                 "with the thresholds, report the worst state and the buckets that are not ok")
+    arg_parser.add_argument("--bucket_size", action="store", type=int, default=100,
+                            help="buckets a terms or significant_terms aggregation returns for --per_bucket without "
+                                 "--aggregation_result_bucket_key (default: 100)")
+    arg_parser.add_argument("--bucket_threshold", action="append", metavar="KEY=WARNING:CRITICAL",
+                            help="thresholds for one bucket with --per_bucket (repeatable argument)")
     arg_parser.add_argument("-d", "--include_day", action="store_true", help="include the day in elasticsearch index")
     arg_parser.add_argument("-p", "--port", action="store", type=int, default=9200, help="elasticsearch port (default: 9200)")
+    arg_parser.add_argument("--time_rounding", action="store", choices=("s", "m", "h", "d"),
+                            help="round the start of the time range down to this unit, e.g. now-600s/m, "
+                                 "so repeated checks can reuse elasticsearch caches")
+    arg_parser.add_argument("--request_cache", action="store_true", help="ask elasticsearch to use the shard request cache")
+    arg_parser.add_argument("--index_cache_ttl", action="store", type=int, default=300,
+                            help="seconds to cache the list of existing indices, missing ones are not searched; "
+                                 "0 disables the check (default: 300)")
+    arg_parser.add_argument("--cache_dir", action="store", default=DEFAULT_CACHE_DIR,
+                            help="directory for local caches (default: %(default)s)")
+    arg_parser.add_argument("--incremental", action="store_true",
+                            help="count per --bucket_interval and cache closed intervals under --cache_dir, "
+                                 "so only the newest intervals are queried (the window start is rounded down to an interval)")
+    arg_parser.add_argument("--bucket_interval", action="store", type=int, default=60,
+                            help="interval in seconds for --incremental (default: 60)")
+    arg_parser.add_argument("--budget_ms", action="store", type=int,
+                            help="latency budget in milliseconds: the client gives up after it and elasticsearch "
+                                 "is asked to stop searching after three quarters of it")
+    arg_parser.add_argument("--terminate_after", action="store", type=int,
+                            help="stop counting after this many documents per shard (checks without aggregation only)")
+    arg_parser.add_argument("--partial_result", action="store", choices=("unknown", "lower_bound", "last_value"),
+                            default="lower_bound",
+                            help="what to do with timed out, terminated early or partially failed searches: report unknown, "
+                                 "use the value as is, or use the last complete value, which is also used when "
+                                 "elasticsearch can't be reached (default: lower_bound)")
+    arg_parser.add_argument("--last_value_max_age", action="store", type=int, default=3600,
+                            help="seconds a last complete value is used for by --partial_result last_value, "
+                                 "older ones give unknown (default: 3600)")
+    arg_parser.add_argument("--fast_http", action="store_true",
+                            help="send the request with the python standard library instead of elasticsearch-py, "
+                                 "which makes one-shot checks start faster")
+    arg_parser.add_argument("--breaker_failures", action="store", type=int, default=0,
+                            help="open a circuit breaker for the host and port, shared by all checks through --cache_dir, "
+                                 "after this many failed (unreachable, timed out, 429 or 5xx) or slow searches in a row; "
+                                 "while it is open checks return "
+                                 "unknown, or the last value with --partial_result last_value, without querying "
+                                 "elasticsearch; 0 disables it (default: 0)")
+    arg_parser.add_argument("--breaker_slow_ms", action="store", type=int,
+                            help="searches taking at least this many milliseconds in elasticsearch count as failed")
+    arg_parser.add_argument("--breaker_backoff", action="store", type=int, default=30,
+                            help="seconds the circuit breaker stays open, doubled every time a probe fails and "
+                                 "randomly shortened by up to half (default: 30)")
+    arg_parser.add_argument("--breaker_max_backoff", action="store", type=int, default=600,
+                            help="the longest the circuit breaker stays open, in seconds (default: 600)")
+    arg_parser.add_argument("--result_cache_ttl", action="store", type=int, default=0,
+                            help="seconds to share a search response under --cache_dir between checks sending the same "
+                                 "request to the same indices, e.g. checks that only differ in thresholds or in the "
+                                 "significant_terms bucket keys they read; 0 disables it (default: 0)")
+    arg_parser.add_argument("--result_cache_size", action="store", type=int, default=256,
+                            help="the number of responses kept by --result_cache_ttl (default: 256)")
     arg_parser.add_argument("-r", "--reverse", action="store_true", help="reverse threshold (so amounts below threshold values will alert)")
+    arg_parser.add_argument("--baseline", action="append", choices=tuple(BASELINE_OFFSETS),
+                            help="compare with the same window before the current one, yesterday or last week "
+                                 "(repeatable argument, the mean of the baselines is used); the baseline windows are "
+                                 "aligned to --time_rounding (default: m), --seconds must be a multiple of it, and "
+                                 "they are searched with the current one in one _msearch and cached under --cache_dir")
+    arg_parser.add_argument("--baseline_compare", action="store", choices=("ratio", "delta"), default="ratio",
+                            help="the value compared with the thresholds: current / baseline or current - baseline "
+                                 "(default: ratio)")
+    arg_parser.add_argument("--template", action="store", metavar="ID",
+                            help="search with the stored search template ID and only send the start of the time range "
+                                 "as its parameter, instead of the whole request body")
+    arg_parser.add_argument("--store_template", action="store_true",
+                            help="instead of checking, store the check's request body as the search template --template "
+                                 "(elasticsearch >= 5.6), for later runs with the same aggregation and query arguments")
+    arg_parser.add_argument("--profile", action="store_true",
+                            help="instead of checking, send the check's search with the profile api enabled and print "
+                                 "its slowest shards, query components, collectors and aggregations")
+    arg_parser.add_argument("--profile_compare", action="store_true",
+                            help="with --profile, also profile the search without aggregations and with a scored "
+                                 "query_string returning 10 hits, as checks searched before filter context")
+    arg_parser.add_argument("--profile_top", action="store", type=int, default=5,
+                            help="entries per --profile section (default: 5)")
     arg_parser.add_argument("--debug", action="store_true", default=False, help="print debug messages")
     arg_parser.add_argument("--version", action="version", version='%(prog)s {version}'.format(version=version))
 
@@ -72,12 +223,154 @@ def parse_args(argv):
 
     flat_bucket_keys(args)
 
+    if args.indices_count and "{hh}" in args.index_pattern:
+        arg_parser.error("--indices_count goes back through daily indices, it can not be combined with an hourly "
+                         "--index_pattern")
+
+    if args.aggregation_type in ("filters", "percentiles", "stats") and not args.aggregation_result_bucket_key:
+        arg_parser.error("--aggregation_type {} requires --aggregation_result_bucket_key".format(args.aggregation_type))
+
+    if args.aggregation_type == "stats":
+        for key in args.aggregation_result_bucket_key:
+            if key not in STATS_VALUES:
+                arg_parser.error("--aggregation_type stats bucket keys must be one of {}: {}"
+                                 .format(", ".join(STATS_VALUES), key))
+
+    if args.aggregation_type == "percentiles":
+        for key in args.aggregation_result_bucket_key:
+            try:
+                percent = float(key)
+            except ValueError:
+                percent = None
+            if percent is None or not 0 <= percent <= 100:
+                arg_parser.error("--aggregation_type percentiles bucket keys must be percents from 0 to 100: {}".format(key))
+
+    if args.aggregation_type in METRIC_AGGREGATIONS:
+        if args.aggregation_result_type == "percentage":
+            arg_parser.error("--aggregation_type {} values can't be a percentage".format(args.aggregation_type))
+        if args.incremental:
+            arg_parser.error("--aggregation_type {} can not be combined with --incremental".format(args.aggregation_type))
+
+    def parse_bucket_thresholds(args):
+        # KEY=WARNING:CRITICAL, the key may contain "=" itself
+        thresholds = {}
+        for threshold in args.bucket_threshold or []:
+            key, _, values = threshold.rpartition("=")
+            try:
+                warning, critical = map(float, values.split(":"))
+            except ValueError:
+                arg_parser.error("--bucket_threshold must look like KEY=WARNING:CRITICAL: {}".format(threshold))
+            thresholds[key] = (warning, critical)
+        args.bucket_threshold = thresholds
+
+    parse_bucket_thresholds(args)
+
+    if args.per_bucket and not (args.aggregation_name and args.aggregation_type and args.aggregation_field):
+        arg_parser.error("--per_bucket requires an aggregation")
+
+    if args.per_bucket and args.reverse and args.aggregation_type in ("terms", "significant_terms") and \
+            not args.aggregation_result_bucket_key:
+        # buckets without documents are never returned, so they could never alert
+        arg_parser.error("--per_bucket with --reverse requires --aggregation_result_bucket_key for --aggregation_type {}"
+                         .format(args.aggregation_type))
+
+    if args.per_bucket and args.partial_result == "last_value":
+        arg_parser.error("--per_bucket can not be combined with --partial_result last_value")
+
+    if args.sample_size:
+        if not (args.aggregation_name and args.aggregation_type and args.aggregation_field):
+            arg_parser.error("--sample_size requires an aggregation")
+        if args.incremental or args.aggregation_type == "composite":
+            arg_parser.error("--sample_size can not be combined with --incremental or --aggregation_type composite")
+
+    if args.sample_diversify_field and not args.sample_size:
+        arg_parser.error("--sample_diversify_field requires --sample_size")
+
+    if args.aggregation_type == "composite" and args.incremental:
+        arg_parser.error("--aggregation_type composite can not be combined with --incremental")
+
+    if args.baseline:
+        if args.incremental or args.per_bucket or args.template or args.aggregation_type == "composite":
+            arg_parser.error("--baseline can not be combined with --incremental, --per_bucket, --template "
+                             "or --aggregation_type composite")
+        if args.partial_result == "last_value":
+            arg_parser.error("--baseline can not be combined with --partial_result last_value")
+        if args.seconds % ROUNDING_SECONDS[args.time_rounding or "m"]:
+            # otherwise the aligned baseline windows are one unit longer or shorter from one check to the next
+            arg_parser.error("--baseline needs --seconds to be a multiple of the --time_rounding unit (default: m)")
+
+    if args.store_template and not args.template:
+        arg_parser.error("--store_template requires --template")
+
+    if args.template and (args.incremental or args.aggregation_type == "composite"):
+        arg_parser.error("--template can not be combined with --incremental or --aggregation_type composite")
+
     return args
 
 
-def build_indices(indices_count=2, index_pattern="{prefix}-{yyyy}.{mm}.{dd}", index_prefix="logstash"):
+def index_granularity(index_pattern):
+    for placeholder, granularity in (("{hh}", "hours"), ("{dd}", "days"), ("{mm}", "months"), ("{yyyy}", "years")):
+        if placeholder in index_pattern:
+            return granularity
+
+    return None
+
+
+def index_periods(start, end, granularity):
+    # the beginning of every index period touched by [start, end], newest first
+    periods = []
+
+    if granularity == "hours":
+        t = start.replace(minute=0, second=0, microsecond=0)
+    elif granularity == "days":
+        t = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif granularity == "months":
+        t = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    else:
+        t = start.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    while t <= end:
+        periods.append(t)
+
+        if granularity == "hours":
+            t += timedelta(hours=1)
+        elif granularity == "days":
+            t += timedelta(days=1)
+        elif granularity == "months":
+            t = (t + timedelta(days=32)).replace(day=1)
+        else:
+            t = t.replace(year=t.year + 1)
+
+    return reversed(periods)
+
+
+def format_index(index_pattern, index_prefix, t):
+    return index_pattern.format(prefix=index_prefix,
+                                yyyy=t.year,
+                                mm="{:02d}".format(t.month),
+                                dd="{:02d}".format(t.day),
+                                hh="{:02d}".format(t.hour))
+
+
+def build_indices(indices_count=2, index_pattern="{prefix}-{yyyy}.{mm}.{dd}", index_prefix="logstash", seconds=None,
+                  now=None):
     indices = []
-    today = datetime.now().date()
+
+    if seconds is not None:
+        # only the indices that can hold documents from [now - seconds, now],
+        # logstash names its indices after the UTC date
+        now = datetime.utcnow() if now is None else now
+        granularity = index_granularity(index_pattern)
+
+        if granularity is None:
+            return format_index(index_pattern, index_prefix, now)
+
+        for t in index_periods(now - timedelta(seconds=seconds), now, granularity):
+            indices.append(format_index(index_pattern, index_prefix, t))
+
+        return ",".join(indices)
+
+    today = datetime.utcnow().date()
 
     for i in range(indices_count):
         t = today - timedelta(days=i)
@@ -89,6 +382,66 @@ def build_indices(indices_count=2, index_pattern="{prefix}-{yyyy}.{mm}.{dd}", in
     return ",".join(indices)
 
 
+def cache_file(args, kind, *key):
+    digest = hashlib.sha1(json.dumps([args.host, args.port] + list(key)).encode("utf-8")).hexdigest()
+    return os.path.join(args.cache_dir, "{}-{}.json".format(kind, digest[:16]))
+
+
+def read_json_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_json_cache(path, data):
+    # concurrent checks share the cache, so never expose a half written file
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        logger.debug("Could not write cache {}: {}".format(path, e))
+
+
+def existing_indices(client, args):
+    wildcard = args.index_pattern.format(prefix=args.index_prefix, yyyy="*", mm="*", dd="*", hh="*")
+    path = cache_file(args, "indices", wildcard)
+
+    cached = read_json_cache(path)
+    if cached and time.time() - cached["fetched_at"] < args.index_cache_ttl:
+        return set(cached["indices"])
+
+    try:
+        # sent through the circuit breaker like the search, an unreachable cluster fails here first
+        indices = [row["index"] for row in send_request(args, lambda: client.cat.indices(index=wildcard, h="index",
+                                                                                           format="json"))]
+    except query_errors() as e:
+        if getattr(e, "status_code", None) != 404:
+            raise
+        indices = []
+
+    write_json_cache(path, {"fetched_at": time.time(), "indices": indices})
+
+    return set(indices)
+
+
+def prune_missing_indices(client, args, index):
+    candidates = index.split(",")
+    existing = existing_indices(client, args)
+
+    # the newest index may have been created after the cache was filled, so it is always kept
+    indices = candidates[:1] + [i for i in candidates[1:] if i in existing]
+    logger.debug("indices: {}, pruned: {}".format(indices, sorted(set(candidates) - set(indices))))
+
+    return ",".join(indices)
+
+
 def calc_percent(part, whole):
     if whole <= int(0):
         return 0
@@ -96,16 +449,19 @@ def calc_percent(part, whole):
     return round(part * 100 / whole, 2)
 
 
-def get_alert_status(args, value):
+def get_alert_status(args, value, warning=None, critical=None):
+    warning = args.warning if warning is None else warning
+    critical = args.critical if critical is None else critical
+
     if args.reverse:
-        if value <= args.critical:
+        if value <= critical:
             return NagiosReturnCodes.CRITICAL.value
-        if value <= args.warning:
+        if value <= warning:
             return NagiosReturnCodes.WARNING.value
     else:
-        if value >= args.critical:
+        if value >= critical:
             return NagiosReturnCodes.CRITICAL.value
-        if value >= args.warning:
+        if value >= warning:
             return NagiosReturnCodes.WARNING.value
 
     return NagiosReturnCodes.OK.value
@@ -115,80 +471,1170 @@ def need_aggregate(args):
     return args.aggregation_name and args.aggregation_type and args.aggregation_field
 
 
-def execute_elastic_query(args):
-    logger.debug(args)
+def build_aggregation(args):
+    keys = args.aggregation_result_bucket_key
+
+    if args.aggregation_type == "filters":
+        return {"filters": {"filters": dict((key, {"term": {args.aggregation_field: key}}) for key in keys)}}
+
+    if args.aggregation_type == "percentiles":
+        return {"percentiles": {"field": args.aggregation_field, "percents": [float(key) for key in keys]}}
+
+    if args.aggregation_type == "composite":
+        return {"composite": {"size": args.composite_page_size,
+                              "sources": [{args.aggregation_name: {"terms": {"field": args.aggregation_field}}}]}}
+
+    if args.aggregation_type == "terms" and keys:
+        # exact counts for just the requested keys, nothing else is aggregated or returned
+        return {"terms": {"field": args.aggregation_field, "include": keys, "size": len(keys)}}
+
+    if args.per_bucket and args.aggregation_type in ("terms", "significant_terms"):
+        # every bucket is compared, not just the 10 elasticsearch returns by default
+        return {args.aggregation_type: {"field": args.aggregation_field, "size": args.bucket_size}}
+
+    return {args.aggregation_type: {"field": args.aggregation_field}}
+
+
+def build_sampler(args):
+    if args.sample_diversify_field:
+        return {"diversified_sampler": {"shard_size": args.sample_size, "field": args.sample_diversify_field}}
+
+    return {"sampler": {"shard_size": args.sample_size}}
+
+
+def needs_raw_body(args):
+    # aggregations elasticsearch_dsl 5 does not know, their request bodies are sent as they are
+    return args.aggregation_type == "composite" or bool(args.sample_size and args.sample_diversify_field)
+
+
+def check_aggregation(args, response):
+    """
+    Returns (aggregation, doc_count, scale): the aggregation of the check, the number of documents it aggregated
+    and the factor scaling its counts to all matching documents, which is only not 1 for --sample_size
+    """
+    doc_count = response["hits"]["total"]
+
+    if not args.sample_size:
+        return response["aggregations"][args.aggregation_name], doc_count, 1
+
+    sample = response["aggregations"][SAMPLE_AGGREGATION]
+    scale = doc_count / float(sample["doc_count"]) if sample["doc_count"] else 1
+    return sample[args.aggregation_name], sample["doc_count"], scale
+
+
+def scale_count(count, scale):
+    return count if scale == 1 else int(round(count * scale))
+
+
+def aggregation_total(args, aggregation, doc_count):
+    # significant_terms reports the foreground set size, terms and filters are relative to the matching documents
+    if args.aggregation_type == "significant_terms":
+        return aggregation["doc_count"]
+
+    return doc_count
+
+
+def iter_buckets(aggregation):
+    for bucket in aggregation["buckets"]:
+        if isinstance(bucket, str):
+            # keyed buckets, e.g. filters
+            yield bucket, aggregation["buckets"][bucket]["doc_count"]
+        else:
+            key = bucket["key"]
+            if isinstance(key, dict):
+                # composite buckets, keyed by their only source
+                key, = key.values()
+            yield key, bucket["doc_count"]
+
+
+def iter_metric_values(args, aggregation, scale=1):
+    """
+    Yields (key, value) for the requested values of a metric aggregation, value is None without matching documents
+    """
+    if args.aggregation_type == "percentiles":
+        values = aggregation["values"]
+        # elasticsearch keys percentiles as "99.0", compare them as numbers
+        percents = dict((float(key), key) for key in values)
+        for key in args.aggregation_result_bucket_key:
+            yield key, values[percents[float(key)]] if float(key) in percents else None
+    elif args.aggregation_type == "stats":
+        for key in args.aggregation_result_bucket_key:
+            value = aggregation[key]
+            # only counts and sums grow with the number of documents, a sample's averages and bounds are estimates as is
+            yield key, value * scale if key in ("count", "sum") and value is not None else value
+    elif args.aggregation_type == "sum" and aggregation["value"] is not None:
+        yield args.aggregation_type, aggregation["value"] * scale
+    else:
+        yield args.aggregation_type, aggregation["value"]
 
-    query = args.query
-    host = args.host
-    port = args.port
+
+def metric_value(args, aggregation, scale=1):
+    # with several percents or stats the most alarming one is used
+    values = [value for key, value in iter_metric_values(args, aggregation, scale) if value is not None]
+    if not values:
+        return None
+
+    return min(values) if args.reverse else max(values)
+
+
+class QueryError(Exception):
+    def __init__(self, message, status_code=None):
+        super(QueryError, self).__init__(message)
+        self.status_code = status_code
+
+
+class BreakerOpen(Exception):
+    pass
+
+
+def query_errors():
+    # only evaluated once a query failed, so checks that never touch the elasticsearch package don't import it
+    from elasticsearch.exceptions import ElasticsearchException
+
+    return QueryError, ElasticsearchException
+
+
+class HTTPCatClient:
+    def __init__(self, client):
+        self.client = client
+
+    def indices(self, index, **params):
+        return self.client.perform_request("GET", "/_cat/indices/{}".format(index), params)
+
+
+class HTTPClient:
+    """
+    Stdlib only stand-in for the few Elasticsearch client calls a check makes, used with --fast_http
+    """
+
+    def __init__(self, host, port, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.cat = HTTPCatClient(self)
+
+    def perform_request(self, method, path, params=None, body=None, timeout=None):
+        import http.client
+        from urllib.parse import quote, urlencode
+
+        url = quote(path, safe="/,*-_.")
+        if params:
+            url = "{}?{}".format(url, urlencode(dict((k, str(v).lower() if isinstance(v, bool) else v)
+                                                     for k, v in params.items())))
+
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=timeout or self.timeout)
+        try:
+            if body is not None and not isinstance(body, str):
+                body = json.dumps(body)
+            connection.request(method, url, body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            raise QueryError("{} {}: {}".format(method, url, e))
+        finally:
+            connection.close()
+
+        if response.status >= 300:
+            raise QueryError("{} {}: {} {}".format(method, url, response.status, data.decode("utf-8", "replace")),
+                             status_code=response.status)
+
+        return json_loads(data)
+
+    def search(self, index, body, request_timeout=None, **params):
+        return self.perform_request("POST", "/{}/_search".format(index), params, body, timeout=request_timeout)
+
+    def search_template(self, index, body, request_timeout=None, **params):
+        return self.perform_request("POST", "/{}/_search/template".format(index), params, body, timeout=request_timeout)
+
+    def msearch(self, body, request_timeout=None, **params):
+        return self.perform_request("POST", "/_msearch", params, "".join(json.dumps(line) + "\n" for line in body),
+                                    timeout=request_timeout)
+
+
+def create_client(host, port, **kwargs):
+    from elasticsearch import Elasticsearch
+
+    if json_loads is not json.loads:
+        kwargs.setdefault("serializer", fast_json_serializer())
+
+    return Elasticsearch(hosts=["{}:{}".format(host, port)], **kwargs)
+
+
+def fast_json_serializer():
+    from elasticsearch.exceptions import SerializationError
+    from elasticsearch.serializer import JSONSerializer
+
+    class FastJSONSerializer(JSONSerializer):
+        def loads(self, s):
+            try:
+                return json_loads(s)
+            except ValueError as e:
+                raise SerializationError(s, e)
+
+    return FastJSONSerializer()
+
+
+def search_indices(args, client=None):
+    if args.indices_count:
+        index = build_indices(indices_count=args.indices_count,
+                              index_pattern=args.index_pattern,
+                              index_prefix=args.index_prefix)
+    else:
+        index = build_indices(index_pattern=args.index_pattern,
+                              index_prefix=args.index_prefix,
+                              seconds=args.seconds)
+
+    if client is not None and args.index_cache_ttl > 0:
+        index = prune_missing_indices(client, args, index)
+
+    return index
+
+
+def window_start(args):
     from_time = "now-{seconds}s".format(seconds=args.seconds)
+    if args.time_rounding:
+        from_time = "{}/{}".format(from_time, args.time_rounding)
+
+    return from_time
+
+
+def build_request_body(args, from_time=None, after_key=None, to_time=None):
+    if from_time is None:
+        time_range = {"gte": window_start(args)}
+    else:
+        time_range = {"gte": from_time, "format": "epoch_millis"}
+        if to_time is not None:
+            time_range["lt"] = to_time
+    aggregate = need_aggregate(args)
+
+    # filter context: no relevance scoring, and the clauses are cacheable by elasticsearch
+    body = {"query": {"bool": {"filter": [{"query_string": {"query": args.query, "analyze_wildcard": True}},
+                                          {"range": {"@timestamp": time_range}}]}}}
+
+    if args.incremental:
+        histogram = {"date_histogram": {"field": "@timestamp",
+                                        "interval": "{}s".format(args.bucket_interval),
+                                        "min_doc_count": 1}}
+        if aggregate:
+            histogram["aggs"] = {args.aggregation_name: build_aggregation(args)}
+        body["aggs"] = {INCREMENTAL_AGGREGATION: histogram}
+    elif aggregate and args.sample_size:
+        body["aggs"] = {SAMPLE_AGGREGATION: dict(build_sampler(args), aggs={args.aggregation_name: build_aggregation(args)})}
+    elif aggregate:
+        body["aggs"] = {args.aggregation_name: build_aggregation(args)}
+        if after_key is not None:
+            body["aggs"][args.aggregation_name]["composite"]["after"] = after_key
+
+    # only hits.total and aggregation buckets are read from the response,
+    # so never let elasticsearch fetch, score and serialize hit documents
+    body["size"] = 0
+
+    if args.budget_ms:
+        # leave the last quarter of the budget for elasticsearch to return what it has got so far
+        body["timeout"] = "{}ms".format(args.budget_ms * 3 // 4)
+
+    if args.terminate_after and not aggregate:
+        body["terminate_after"] = args.terminate_after
+
+    return body
+
+
+def build_template_source(args):
+    # mustache source of the request body, the start of the time range is the only parameter
+    body = build_request_body(args)
+    body["query"]["bool"]["filter"][1]["range"]["@timestamp"]["gte"] = "{{from}}"
+
+    return json.dumps(body)
+
+
+def build_template_request(args):
+    return {"id": args.template, "params": {"from": window_start(args)}}
+
+
+def store_template(args, client=None):
+    if client is None:
+        client = HTTPClient(args.host, args.port) if args.fast_http else create_client(args.host, args.port)
+
+    path = "/_scripts/{}".format(args.template)
+    body = {"script": {"lang": "mustache", "source": build_template_source(args)}}
+
+    try:
+        if isinstance(client, HTTPClient):
+            client.perform_request("PUT", path, body=body)
+        else:
+            client.transport.perform_request("PUT", path, body=body)
+    except query_errors() as e:
+        return NagiosReturnCodes.UNKNOWN.value, "Got elasticsearch exception: {}".format(e)
+
+    return NagiosReturnCodes.OK.value, "Stored the search template {}".format(args.template)
+
+
+def build_search_params(args):
+    params = {}
+
+    # the search template endpoint has no request_cache parameter, its size 0 searches use the cache by default
+    if args.request_cache and not args.template:
+        params["request_cache"] = True
+
+    if args.budget_ms:
+        params["request_timeout"] = args.budget_ms / 1000.0
+
+    return params
+
+
+def dsl_search(client, index, body, params):
+    from elasticsearch_dsl import Search
+
+    return Search(using=client, index=index).update_from_dict(body).params(**params)
+
+
+def build_search(args, client=None, from_time=None):
+    return dsl_search(client, search_indices(args, client), build_request_body(args, from_time), build_search_params(args))
+
+
+def result_cache_file(args, index, body):
+    return cache_file(args, "result", index, body)
+
+
+def read_result_cache(args, path):
+    cached = read_json_cache(path)
+    if cached is None or time.time() - cached["stored_at"] >= args.result_cache_ttl:
+        return None
+
+    logger.debug("result cache hit: {}".format(path))
+    return cached["response"]
+
+
+def write_result_cache(args, path, response):
+    # partial responses are never shared, the next check searches again
+    if is_partial_response(response):
+        return
+
+    write_json_cache(path, {"stored_at": time.time(), "response": response})
+
+    # size bound: drop the least recently stored results
+    try:
+        results = [os.path.join(args.cache_dir, name) for name in os.listdir(args.cache_dir) if name.startswith("result-")]
+        if len(results) > args.result_cache_size:
+            results.sort(key=os.path.getmtime)
+            for old_path in results[:len(results) - args.result_cache_size]:
+                os.unlink(old_path)
+    except (IOError, OSError) as e:
+        logger.debug("Could not evict result cache: {}".format(e))
+
+
+def before_request(args):
+    # requests are not sent while the circuit breaker is open
+    if args.breaker_failures and not breaker_allows(args):
+        raise BreakerOpen()
+
+
+def after_request(args, response=None, error=None):
+    if args.breaker_failures:
+        failed = is_breaker_failure(error) if error is not None else is_slow_response(args, response)
+        record_breaker_result(args, failed=failed)
+
+
+def send_request(args, request, timings=None):
+    """
+    Returns request(), timed and sent through the circuit breaker
+    """
+    before_request(args)
+
+    try:
+        with timed(timings, "request"):
+            response = request()
+    except query_errors() as e:
+        after_request(args, error=e)
+        raise
+
+    after_request(args, response)
+
+    return response
+
+
+def prepare_search(args, client, from_time=None, timings=None, after_key=None):
+    """
+    Returns (index, body, params, cache_path, response), response is None unless the result cache has got it
+    """
+    with timed(timings, "build"):
+        index = search_indices(args, client)
+        body = build_template_request(args) if args.template else build_request_body(args, from_time, after_key)
+        params = build_search_params(args)
+
+    cache_path = response = None
+    if args.result_cache_ttl > 0:
+        with timed(timings, "cache"):
+            cache_path = result_cache_file(args, index, body)
+            response = read_result_cache(args, cache_path)
+
+    return index, body, params, cache_path, response
+
+
+def perform_search(args, client, from_time=None, timings=None, after_key=None):
+    index, body, params, cache_path, response = prepare_search(args, client, from_time, timings, after_key)
+    if response is not None:
+        return response
+
+    def request():
+        if args.template:
+            return client.search_template(index=index, body=body, **params)
+        # the raw response is decoded once, elasticsearch_dsl would wrap every bucket in an AttrDict
+        return client.search(index=index, body=body, **params)
+
+    response = send_request(args, request, timings)
+
+    if cache_path:
+        with timed(timings, "cache"):
+            write_result_cache(args, cache_path, response)
+
+    return response
+
+
+def execute_elastic_query(args, client=None, timings=None):
+    logger.debug(args)
+
+    if client is None:
+        if args.fast_http:
+            client = HTTPClient(args.host, args.port, timeout=args.budget_ms / 1000.0 if args.budget_ms else None)
+        else:
+            with timed(timings, "imports"):
+                import elasticsearch  # noqa: F401, imported here to be timed on its own
+
+            with timed(timings, "client"):
+                client = create_client(args.host, args.port)
+
+    if args.incremental:
+        return execute_incremental_query(args, client, timings)
+
+    if args.baseline:
+        return execute_baseline_query(args, client, timings)
+
+    if args.aggregation_type == "composite" and need_aggregate(args):
+        return execute_composite_query(args, client, timings)
+
+    return perform_search(args, client, timings=timings)
+
+
+def baseline_windows(args, now=None):
+    """
+    Returns (windows, scale): {baseline: (start, end)} in epoch milliseconds, closed windows aligned to --time_rounding
+    that only change, and need to be searched again, when the next unit starts, and the factor scaling their counts
+    to the length of the current window
+    """
+    unit = ROUNDING_SECONDS[args.time_rounding or "m"] * 1000
+    now = int((time.time() if now is None else now) * 1000)
+    start = (now - args.seconds * 1000) // unit * unit
+    end = now // unit * unit
+
+    windows = OrderedDict()
+    for baseline in args.baseline:
+        offset = end - start if baseline == "previous" else BASELINE_OFFSETS[baseline] * 1000
+        windows[baseline] = (start - offset, end - offset)
+
+    current_length = now - start if args.time_rounding else args.seconds * 1000
+    return windows, current_length / float(end - start)
+
+
+def is_additive(args):
+    # values that grow with the length of the window, unlike percentages, averages or percentiles
+    if not need_aggregate(args):
+        return True
+
+    if args.aggregation_type in METRIC_AGGREGATIONS:
+        return args.aggregation_type == "sum"
+
+    return args.aggregation_result_type == "count"
+
+
+def execute_baseline_query(args, client, timings=None):
+    """
+    Returns the response of the current window with the value of every --baseline window under "baselines",
+    the windows missing from the local cache are searched together with the current one in one _msearch
+    """
+    windows, scale = baseline_windows(args)
+    path = cache_file(args, "baseline", args.query, args.index_pattern, args.index_prefix, args.seconds, args.time_rounding,
+                      args.aggregation_name, args.aggregation_type, args.aggregation_field,
+                      args.aggregation_result_bucket_key, args.aggregation_result_type, args.sample_size)
+
+    # keyed by "start:end", windows older than the oldest one needed now are never searched again
+    oldest = min(start for start, end in windows.values())
+    values = dict((key, value) for key, value in (read_json_cache(path) or {}).items() if int(key.split(":")[0]) >= oldest)
+
+    with timed(timings, "build"):
+        params = build_search_params(args)
+        header = {"request_cache": True} if params.pop("request_cache", False) else {}
+        searches = [dict(header, index=search_indices(args, client)), build_request_body(args)]
+        missing = []
+
+        for baseline, (start, end) in windows.items():
+            key = "{}:{}".format(start, end)
+            if key in values or key in missing:
+                continue
+
+            missing.append(key)
+            index = build_indices(index_pattern=args.index_pattern, index_prefix=args.index_prefix,
+                                  seconds=(end - start) // 1000, now=datetime.utcfromtimestamp(end / 1000.0))
+            # indices of past windows may have been deleted already
+            searches.extend([dict(header, index=index, ignore_unavailable=True),
+                             build_request_body(args, from_time=start, to_time=end)])
+
+    responses = send_request(args, lambda: client.msearch(body=searches, **params), timings)["responses"]
+    for response in responses:
+        if "error" in response:
+            raise QueryError("_msearch: {}".format(json.dumps(response["error"])), status_code=response.get("status"))
+
+    partial = set()
+    for key, response in zip(missing, responses[1:]):
+        if response_value(response, "_shards", "total") == 0:
+            # retention deleted every index of the window, no documents is not a baseline of 0
+            values[key] = None
+        else:
+            values[key] = handle_elastic_response(args, response)
+        if is_partial_response(response):
+            # used this time, but searched again by the next check
+            partial.add(key)
+    if missing:
+        write_json_cache(path, dict((key, value) for key, value in values.items() if key not in partial))
+
+    response = dict(responses[0])
+    response["baselines"] = OrderedDict()
+    for baseline, (start, end) in windows.items():
+        value = values["{}:{}".format(start, end)]
+        response["baselines"][baseline] = value * scale if value is not None and is_additive(args) else value
+
+    return response
+
+
+def execute_composite_query(args, client, timings=None):
+    """
+    Returns the first composite aggregation page, its buckets replaced by a generator
+    that fetches the following pages while the response is handled
+    """
+    # --budget_ms bounds all the pages together
+    deadline = time.perf_counter() + args.budget_ms / 1000.0 if args.budget_ms else None
+    page = perform_search(args, client, timings=timings)
+
+    response = dict((key, value) for key, value in page.items() if key != "aggregations")
+    response["aggregations"] = {args.aggregation_name: {"buckets": composite_buckets(args, client, response, page, deadline)}}
+
+    return response
+
+
+def composite_buckets(args, client, response, page, deadline=None):
+    while True:
+        aggregation = page["aggregations"][args.aggregation_name]
+        buckets = aggregation["buckets"]
+        for bucket in buckets:
+            yield bucket
+
+        if len(buckets) < args.composite_page_size:
+            return
+
+        # after_key is only returned since elasticsearch 6.3, the last bucket key works with 6.1 too
+        after_key = aggregation.get("after_key") or buckets[-1]["key"]
+        # drop the previous page before fetching the next one, it is timed as part of handling the response
+        page = buckets = aggregation = None
+
+        if deadline is None:
+            page = perform_search(args, client, after_key=after_key)
+        elif deadline - time.perf_counter() >= 0.001:
+            # every page only gets what is left of the latency budget
+            page_args = copy.copy(args)
+            page_args.budget_ms = int((deadline - time.perf_counter()) * 1000)
+            try:
+                page = perform_search(page_args, client, after_key=after_key)
+            except query_errors():
+                if time.perf_counter() < deadline:
+                    raise
+
+        if page is None:
+            logger.warning("Latency budget used up, the following composite aggregation pages are missing")
+            response["timed_out"] = True
+            return
+
+        took = response_value(page, "took")
+        if took is not None:
+            response["took"] = (response_value(response, "took") or 0) + took
+        if is_partial_response(page):
+            for key in ("timed_out", "terminated_early", "_shards"):
+                if response_value(page, key):
+                    response[key] = page[key]
+
+
+def execute_incremental_query(args, client, timings=None):
     aggregate = need_aggregate(args)
+    # keyed by the aggregation as it is sent, bucket keys and sizes change what each interval holds
+    path = cache_file(args, "buckets", args.query, args.index_pattern, args.index_prefix, args.seconds, args.bucket_interval,
+                      args.aggregation_name, build_aggregation(args) if aggregate else None)
+
+    now = int(time.time() * 1000)
+    interval = args.bucket_interval * 1000
+    window_start = (now - args.seconds * 1000) // interval * interval
+
+    cached = read_json_cache(path) or {"fetched_at": 0, "buckets": {}}
+    buckets = dict((int(key), bucket) for key, bucket in cached["buckets"].items() if int(key) >= window_start)
+
+    # intervals that had ended at the previous run are closed, except the last one is fetched
+    # again to pick up documents that were indexed late
+    from_time = max(window_start, cached["fetched_at"] // interval * interval - interval)
+    buckets = dict((key, bucket) for key, bucket in buckets.items() if key < from_time)
 
-    index = build_indices(indices_count=args.indices_count,
-                          index_pattern=args.index_pattern,
-                          index_prefix=args.index_prefix)
+    response = perform_search(args, client, from_time=from_time, timings=timings)
 
-    client = Elasticsearch(hosts=["{}:{}".format(host, port)])
+    for bucket in response["aggregations"][INCREMENTAL_AGGREGATION]["buckets"]:
+        buckets[int(bucket["key"])] = {"doc_count": bucket["doc_count"]}
+        if aggregate:
+            aggregation = bucket[args.aggregation_name]
+            buckets[int(bucket["key"])].update({
+                "aggregation_doc_count": aggregation_total(args, aggregation, bucket["doc_count"]),
+                "aggregation_buckets": dict((str(key), doc_count) for key, doc_count in iter_buckets(aggregation))
+            })
 
-    s = Search(using=client, index=index) \
-        .query("query_string", query=query, analyze_wildcard=True) \
-        .query("range", **{"@timestamp": {"gte": "{}".format(from_time)}})
+    if is_partial_response(response):
+        # undercounted intervals must not be cached as closed, the next check fetches them again
+        logger.debug("incremental buckets: partial response, not cached")
+    else:
+        write_json_cache(path, {"fetched_at": now, "buckets": buckets})
+    logger.debug("incremental buckets: fetched from {}, cached {}".format(from_time, len(buckets)))
+
+    # same shape as a regular search response, so handle_elastic_response can read it
+    merged = dict((key, response_value(response, key)) for key in ("took", "timed_out", "_shards")
+                  if response_value(response, key) is not None)
+    merged["hits"] = {"total": sum(bucket["doc_count"] for bucket in buckets.values()), "hits": []}
 
     if aggregate:
-        s.aggs.bucket(args.aggregation_name, A(args.aggregation_type, field=args.aggregation_field))
+        counts = {}
+        for bucket in buckets.values():
+            for key, doc_count in bucket["aggregation_buckets"].items():
+                counts[key] = counts.get(key, 0) + doc_count
 
-    return s.execute()
+        merged["aggregations"] = {args.aggregation_name: {
+            "doc_count": sum(bucket["aggregation_doc_count"] for bucket in buckets.values()),
+            "buckets": [{"key": key, "doc_count": doc_count}
+                        for key, doc_count in sorted(counts.items(), key=lambda item: item[1], reverse=True)]
+        }}
+
+    return merged
 
 
 def handle_elastic_response(args, response):
     result = 0
 
-    if need_aggregate(args):
-        res_aggregation = {}
-
-        for bucket in response.aggregations[args.aggregation_name].buckets:
-            res_aggregation.update({bucket.key:
-                                        {"count": bucket.doc_count,
-                                         "percentage": calc_percent(bucket.doc_count,
-                                                                    response.aggregations[args.aggregation_name].doc_count)}
-                                    })
-        logger.debug(res_aggregation)
+    if need_aggregate(args) and args.aggregation_type in METRIC_AGGREGATIONS:
+        aggregation, documents, scale = check_aggregation(args, response)
+        result = metric_value(args, aggregation, scale)
+    elif need_aggregate(args):
+        aggregation, documents, scale = check_aggregation(args, response)
+        keys = args.aggregation_result_bucket_key
+        count = 0
 
-        # does not metter result_type is percentage or count
-        if args.aggregation_result_bucket_key is None:
+        # buckets are streamed, only the requested ones are counted and nothing is kept
+        if keys is None and args.aggregation_type == "composite":
+            # composite buckets are ordered by key, take the largest one
+            for key, doc_count in iter_buckets(aggregation):
+                count = max(count, doc_count)
+        elif keys is None:
             # if there is no aggregation_result_bucket_key, so take the first one
-            max_aggregated_value_tuple = list(res_aggregation.items())[0]
-            result = max_aggregated_value_tuple[1][args.aggregation_result_type]
+            for key, doc_count in iter_buckets(aggregation):
+                count = doc_count
+                break
         else:
-            for field in args.aggregation_result_bucket_key:
-                result += res_aggregation.get(field).get(args.aggregation_result_type) if res_aggregation.get(field) else 0
+            keys = set(keys)
+            for key, doc_count in iter_buckets(aggregation):
+                if str(key) in keys:
+                    count += doc_count
+        logger.debug("aggregated count: {}".format(count))
+
+        if args.aggregation_result_type == "percentage":
+            result = calc_percent(count, aggregation_total(args, aggregation, documents))
+        else:
+            result = scale_count(count, scale)
     else:
-        result = response.hits.total
+        result = response["hits"]["total"]
 
     return result
 
 
-def main(argv):
-    args = parse_args(argv)
+def handle_bucket_values(args, response):
+    """
+    Returns [(key, value)] for every bucket, or for every --aggregation_result_bucket_key with 0 for missing buckets
+    """
+    aggregation, doc_count, scale = check_aggregation(args, response)
+    keys = args.aggregation_result_bucket_key
 
-    if args.debug:
-        logging.getLogger().setLevel(level=logging.DEBUG)
+    if args.aggregation_type in METRIC_AGGREGATIONS:
+        return list(iter_metric_values(args, aggregation, scale))
 
-    result = 0
+    total = aggregation_total(args, aggregation, doc_count)
+
+    def value(count):
+        return calc_percent(count, total) if args.aggregation_result_type == "percentage" else scale_count(count, scale)
+
+    if keys is None:
+        return [(str(key), value(doc_count)) for key, doc_count in iter_buckets(aggregation)]
+
+    counts = dict((key, 0) for key in keys)
+    for key, doc_count in iter_buckets(aggregation):
+        if str(key) in counts:
+            counts[str(key)] += doc_count
+
+    return [(key, value(counts[key])) for key in keys]
+
+
+def format_perfdata(label, value, uom="", warning="", critical=""):
+    if isinstance(value, float):
+        value = round(value, 6)
+
+    # "=" separates the label from the value, it is not allowed even in quoted labels
+    label = label.replace("=", "_")
+    if any(c in label for c in " '"):
+        label = "'{}'".format(label.replace("'", "''"))
+
+    return "{label}={value}{uom};{warning};{critical};;".format(label=label, value=value, uom=uom,
+                                                               warning=warning, critical=critical)
+
+
+def build_perfdata(args, result, response, timings, buckets=(), values=()):
+    perfdata = [format_perfdata("value", result, warning=args.warning, critical=args.critical)]
+
+    for label, value in values:
+        perfdata.append(format_perfdata(label, value))
+
+    for key, value, warning, critical in buckets:
+        perfdata.append(format_perfdata("bucket_{}".format(key), value, warning=warning, critical=critical))
+
+    if timings:
+        for phase, seconds in timings.items():
+            perfdata.append(format_perfdata("time_{}".format(phase), seconds, uom="s"))
+        perfdata.append(format_perfdata("time_total", sum(timings.values()), uom="s"))
+
+    if args.sample_size:
+        for label, path in (("sample_size", ("aggregations", SAMPLE_AGGREGATION, "doc_count")),
+                            ("sample_of", ("hits", "total"))):
+            value = response_value(response, *path)
+            if isinstance(value, (int, float)):
+                perfdata.append(format_perfdata(label, int(value)))
+
+    # server side statistics, missing from responses that were not returned by elasticsearch itself
+    for label, path, uom in (("es_took", ("took",), "ms"),
+                             ("es_timed_out", ("timed_out",), ""),
+                             ("es_shards_total", ("_shards", "total"), ""),
+                             ("es_shards_failed", ("_shards", "failed"), "")):
+        value = response_value(response, *path)
+        if isinstance(value, (int, float)):
+            perfdata.append(format_perfdata(label, int(value), uom=uom))
+
+    return " ".join(perfdata)
+
+
+def format_status(args, alert_status, result, perfdata=None, details=None):
+    status = "Exited with: {alert_status}, Current Value: {value}, Critical: {critical}, Warning: {warning}" \
+        .format(alert_status=alert_status, value=result, critical=args.critical, warning=args.warning)
+
+    if details:
+        status = "{}, {}".format(status, details)
+
+    if perfdata:
+        status = "{} | {}".format(status, perfdata)
+
+    return status
+
+
+def response_value(response, *path):
+    # top level response fields such as took or _shards, None when the response does not have them
     try:
-        logger.debug("args: {}".format(args))
+        value = response
+        for key in path:
+            value = value[key]
+    except (KeyError, TypeError):
+        return None
 
-        response = execute_elastic_query(args)
-        result = handle_elastic_response(args, response)
-    except exceptions.ElasticsearchException as e:
-        logger.error("Got elasticsearch exception: {}".format(e))
-        exit(NagiosReturnCodes.UNKNOWN.value)
+    return value
+
+
+def is_partial_response(response):
+    return any(response_value(response, *path) for path in (("timed_out",), ("terminated_early",), ("_shards", "failed")))
 
+
+def last_value_file(args):
+    return cache_file(args, "last_value", args.query, args.index_pattern, args.index_prefix, args.seconds,
+                      args.aggregation_name, args.aggregation_type, args.aggregation_field,
+                      args.aggregation_result_bucket_key, args.aggregation_result_type)
+
+
+def read_last_value(args):
+    cached = read_json_cache(last_value_file(args))
+    if cached is None:
+        return None
+
+    age = int(time.time() - cached["stored_at"])
+    if age > args.last_value_max_age:
+        logger.warning("The last complete value {} from {} seconds ago is too old".format(cached["value"], age))
+        return None
+
+    logger.warning("Using the last complete value {} from {} seconds ago".format(cached["value"], age))
+    return cached["value"]
+
+
+def evaluate_response(args, response, timings=None):
+    if args.per_bucket:
+        return evaluate_buckets(args, response, timings)
+
+    if args.baseline:
+        return evaluate_baseline(args, response, timings)
+
+    with timed(timings, "handle"):
+        result = handle_elastic_response(args, response)
     logger.debug("result: {}".format(result))
 
+    if result is None:
+        return NagiosReturnCodes.UNKNOWN.value, "No {} value, no documents matched".format(args.aggregation_type)
+
+    if is_partial_response(response):
+        logger.warning("Got a partial result from elasticsearch: {}".format(result))
+
+        if args.partial_result == "unknown":
+            return NagiosReturnCodes.UNKNOWN.value, "Partial result from elasticsearch: {}".format(result)
+
+        if args.partial_result == "last_value":
+            result = read_last_value(args)
+            if result is None:
+                return NagiosReturnCodes.UNKNOWN.value, "Partial result from elasticsearch and no recent last value"
+    elif args.partial_result == "last_value":
+        write_json_cache(last_value_file(args), {"value": result, "stored_at": time.time()})
+
     alert_status = get_alert_status(args, result)
-    logger.info("Exited with: {alert_status}, Current Value: {value}, Critical: {critical}, Warning: {warning}"
-                .format(alert_status=alert_status, value=result, critical=args.critical, warning=args.warning))
+    return alert_status, format_status(args, alert_status, result, build_perfdata(args, result, response, timings))
+
+
+def evaluate_baseline(args, response, timings=None):
+    with timed(timings, "handle"):
+        current = handle_elastic_response(args, response)
+    baselines = response["baselines"]
+    values = [value for value in baselines.values() if value is not None]
+
+    if current is None or not values:
+        return NagiosReturnCodes.UNKNOWN.value, "No {} value to compare with the baseline".format(
+            args.aggregation_type or "count")
+
+    if is_partial_response(response):
+        logger.warning("Got a partial result from elasticsearch: {}".format(current))
+
+        if args.partial_result == "unknown":
+            return NagiosReturnCodes.UNKNOWN.value, "Partial result from elasticsearch: {}".format(current)
+
+    baseline = sum(values) / float(len(values))
+    if args.baseline_compare == "delta":
+        result = round(current - baseline, 2)
+    elif baseline:
+        result = round(current / baseline, 3)
+    else:
+        # nothing to compare with, only a change from nothing to something is infinitely large
+        result = float("inf") if current else 1.0
+
+    details = "Current: {}, Baseline: {} ({})".format(
+        current, round(baseline, 2),
+        ", ".join("{}={}".format(name, "none" if value is None else round(value, 2)) for name, value in baselines.items()))
+    perfdata = build_perfdata(args, result, response, timings,
+                              values=[("current", current)] + [("baseline_{}".format(name), "U" if value is None else value)
+                                                               for name, value in baselines.items()])
+
+    alert_status = get_alert_status(args, result)
+    return alert_status, format_status(args, alert_status, result, perfdata, details)
+
+
+def evaluate_buckets(args, response, timings=None):
+    with timed(timings, "handle"):
+        values = handle_bucket_values(args, response)
+
+    if is_partial_response(response):
+        logger.warning("Got a partial result from elasticsearch for {} buckets".format(len(values)))
+
+        if args.partial_result == "unknown":
+            return NagiosReturnCodes.UNKNOWN.value, "Partial result from elasticsearch for {} buckets".format(len(values))
+
+    alert_status = NagiosReturnCodes.OK.value
+    result = None
+    buckets = []
+    offending = []
+
+    for key, value in values:
+        warning, critical = args.bucket_threshold.get(key, (args.warning, args.critical))
+        if value is None:
+            # metric aggregations without matching documents, "U" is the unknown perfdata value
+            buckets.append((key, "U", warning, critical))
+            continue
+
+        status = get_alert_status(args, value, warning, critical)
+        buckets.append((key, value, warning, critical))
+
+        if status != NagiosReturnCodes.OK.value:
+            offending.append("{}={} ({})".format(key, value, NagiosReturnCodes(status).name))
+
+        # the current value is the one of the worst bucket, the most extreme one among equally bad buckets
+        if result is None or status > alert_status or \
+                status == alert_status and (value < result if args.reverse else value > result):
+            alert_status, result = status, value
+
+    if result is None:
+        result = 0
+
+    details = "Buckets: {}".format(", ".join(offending)) if offending else None
+    return alert_status, format_status(args, alert_status, result, build_perfdata(args, result, response, timings, buckets),
+                                       details)
+
+
+def check_failed(args, error, timings=None):
+    logger.error("Got elasticsearch exception: {}".format(error))
+
+    return unknown_or_last_value(args, "Got elasticsearch exception: {}".format(error), timings)
+
+
+def unknown_or_last_value(args, message, timings=None):
+    result = read_last_value(args) if args.partial_result == "last_value" else None
+    if result is None:
+        return NagiosReturnCodes.UNKNOWN.value, message
+
+    alert_status = get_alert_status(args, result)
+    return alert_status, format_status(args, alert_status, result, build_perfdata(args, result, None, timings))
+
+
+@contextmanager
+def breaker_state(args):
+    """
+    Yields the circuit breaker state of the host and port, locked against other checks and written back on exit
+    """
+    path = cache_file(args, "breaker")
+    try:
+        if not os.path.isdir(args.cache_dir):
+            os.makedirs(args.cache_dir)
+        lock = open("{}.lock".format(path), "a")
+    except (IOError, OSError) as e:
+        # a check without the shared state still runs, as if the breaker were closed
+        logger.debug("Could not lock the circuit breaker state {}: {}".format(path, e))
+        yield {"failures": 0, "opened": 0, "open_until": 0, "probe_until": 0}
+        return
+
+    with lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            state = read_json_cache(path) or {"failures": 0, "opened": 0, "open_until": 0, "probe_until": 0}
+            yield state
+            write_json_cache(path, state)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def breaker_allows(args):
+    """
+    False while the circuit breaker is open, once it may be half-open only one check at a time probes elasticsearch
+    """
+    now = time.time()
+
+    with breaker_state(args) as state:
+        if now < state["open_until"] or now < state["probe_until"]:
+            return False
+
+        if state["opened"]:
+            # half-open, let this check probe and keep the others out until it reports back
+            state["probe_until"] = now + BREAKER_PROBE_TIMEOUT
+
+    return True
+
+
+def record_breaker_result(args, failed):
+    with breaker_state(args) as state:
+        state["probe_until"] = 0
+
+        if not failed:
+            state.update({"failures": 0, "opened": 0, "open_until": 0})
+            return
+
+        state["failures"] += 1
+        if state["opened"] or state["failures"] >= args.breaker_failures:
+            # jittered, so checks sharing the breaker don't all probe at the same time
+            backoff = min(args.breaker_max_backoff, args.breaker_backoff * 2 ** state["opened"])
+            state.update({"failures": 0, "opened": state["opened"] + 1,
+                          "open_until": time.time() + backoff * random.uniform(0.5, 1.0)})
+            logger.warning("Opened the circuit breaker for {}:{} for up to {} seconds".format(args.host, args.port, backoff))
+
+
+def is_breaker_failure(error):
+    # unreachable, timed out or overloaded, other 4xx errors come from a broken check that must not silence the others
+    status_code = getattr(error, "status_code", None)
+    return not isinstance(status_code, int) or status_code == 429 or status_code >= 500
+
+
+def is_slow_response(args, response):
+    took = response_value(response, "took")
+    return args.breaker_slow_ms is not None and isinstance(took, (int, float)) and took >= args.breaker_slow_ms
+
+
+def breaker_open(args, timings=None):
+    logger.warning("The circuit breaker for {}:{} is open, not querying elasticsearch".format(args.host, args.port))
+
+    return unknown_or_last_value(args, "Circuit breaker open for {}:{}, elasticsearch was not queried"
+                                 .format(args.host, args.port), timings)
+
+
+def run_check(args, client=None, timings=None):
+    try:
+        logger.debug("args: {}".format(args))
+
+        response = execute_elastic_query(args, client, timings)
+        # composite aggregation pages are still fetched while the response is evaluated
+        return evaluate_response(args, response, timings)
+    except BreakerOpen:
+        return breaker_open(args, timings)
+    except query_errors() as e:
+        return check_failed(args, e, timings)
+
+
+def profile_variants(args):
+    body = build_request_body(args)
+    variants = OrderedDict([("check", body)])
+
+    if args.profile_compare:
+        if "aggs" in body:
+            variants["count only"] = dict((key, value) for key, value in body.items() if key != "aggs")
+
+        query_string, time_range = body["query"]["bool"]["filter"]
+        variants["scored, 10 hits"] = dict(body, query={"bool": {"must": [query_string], "filter": [time_range]}}, size=10)
+
+    for name, variant in variants.items():
+        variants[name] = dict(variant, profile=True)
+
+    return variants
+
+
+def profile_nanos(node):
+    if "time_in_nanos" in node:
+        return node["time_in_nanos"]
+
+    # elasticsearch < 5.2 only reports human readable times, e.g. "1.237ms"
+    units = (("micros", 1e3), ("nanos", 1), ("ms", 1e6), ("s", 1e9))
+    value = node.get("time", "0ms")
+    for unit, nanos in units:
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * nanos)
+
+    return 0
+
+
+def iter_profile_nodes(nodes, depth=0):
+    for node in nodes:
+        yield depth, node
+        for child in iter_profile_nodes(node.get("children", []), depth + 1):
+            yield child
+
+
+def format_profile_entry(nanos, label):
+    label = label if len(label) <= 100 else label[:97] + "..."
+    return "  {:>10.3f} ms  {}".format(nanos / 1e6, label)
+
+
+def summarize_profile(response, top=5):
+    """
+    Returns the report lines of a profiled search: shards by time and query components, collectors and
+    aggregations summed over the shards
+    """
+    shards = []
+    components = {}
+    collectors = {}
+    aggregations = {}
+
+    for shard in response["profile"]["shards"]:
+        shard_nanos = 0
+
+        for search in shard["searches"]:
+            shard_nanos += search.get("rewrite_time", 0)
+            for depth, node in iter_profile_nodes(search["query"]):
+                if depth == 0:
+                    shard_nanos += profile_nanos(node)
+                key = "{}: {}".format(node["type"], node["description"])
+                components[key] = components.get(key, 0) + profile_nanos(node)
+            for _, node in iter_profile_nodes(search["collector"]):
+                key = "{} ({})".format(node["name"], node["reason"])
+                collectors[key] = collectors.get(key, 0) + profile_nanos(node)
+
+        for depth, node in iter_profile_nodes(shard.get("aggregations", [])):
+            if depth == 0:
+                shard_nanos += profile_nanos(node)
+            key = "{}: {}".format(node["type"], node["description"])
+            aggregations[key] = aggregations.get(key, 0) + profile_nanos(node)
+
+        shards.append((shard_nanos, shard["id"]))
+
+    lines = []
+    for title, entries in (("slowest shards", shards),
+                           ("query components", [(nanos, key) for key, nanos in components.items()]),
+                           ("collectors", [(nanos, key) for key, nanos in collectors.items()]),
+                           ("aggregations", [(nanos, key) for key, nanos in aggregations.items()])):
+        if entries:
+            lines.append("{}:".format(title))
+            lines.extend(format_profile_entry(nanos, label)
+                         for nanos, label in sorted(entries, key=lambda entry: entry[0], reverse=True)[:top])
+
+    return lines
+
+
+def run_profile(args, client=None):
+    if client is None:
+        client = HTTPClient(args.host, args.port) if args.fast_http else create_client(args.host, args.port)
+
+    lines = []
+    comparison = []
+
+    try:
+        index = search_indices(args, client)
+        for name, body in profile_variants(args).items():
+            started = time.perf_counter()
+            response = client.search(index=index, body=body, **build_search_params(args))
+            elapsed = time.perf_counter() - started
+
+            comparison.append("  {:<16} took {:>6} ms, round trip {:>8.1f} ms, hits.total {}"
+                              .format(name, response_value(response, "took"), elapsed * 1000,
+                                      response_value(response, "hits", "total")))
+            lines.append("Profile of the {} search on {}".format(name, index))
+            lines.extend(summarize_profile(response, args.profile_top))
+    except BreakerOpen:
+        return breaker_open(args)
+    except query_errors() as e:
+        return NagiosReturnCodes.UNKNOWN.value, "Got elasticsearch exception: {}".format(e)
+
+    if len(comparison) > 1:
+        lines.append("comparison:")
+        lines.extend(comparison)
+
+    return NagiosReturnCodes.OK.value, "\n".join(lines)
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+
+    timings = OrderedDict()
+
+    startup = startup_time()
+    if startup is not None:
+        timings["startup"] = startup
+
+    with timed(timings, "parse"):
+        args = parse_args(argv)
+
+    if args.debug:
+        logging.getLogger().setLevel(level=logging.DEBUG)
+
+    if args.store_template or args.profile:
+        alert_status, output = store_template(args) if args.store_template else run_profile(args)
+        print(output)
+        exit(alert_status)
+
+    alert_status, output = run_check(args, timings=timings)
+
+    if alert_status != NagiosReturnCodes.UNKNOWN.value:
+        logger.info(output)
+    print(output)
     exit(alert_status)
 
 
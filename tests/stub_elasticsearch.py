@@ -0,0 +1,238 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+
+class StubElasticsearch:
+    """In-process stand-in for an elasticsearch node.
+
+    Serves _search, _msearch, _count, _cat/indices and stored search templates
+    with synthetic responses sized by ``total`` and ``bucket_count``, or with
+    recorded responses put into ``recorded`` (keyed by endpoint, e.g. "_search").
+    Metric aggregations see a numeric field spread from 1 to 1000. Every request
+    is delayed by ``latency`` seconds and kept in ``requests`` as
+    (method, path, params, body).
+
+        with StubElasticsearch(bucket_count=1000) as es:
+            main(["--host", es.host, "--port", str(es.port), ...])
+    """
+
+    def __init__(self, total=1000, bucket_count=10, latency=0.0, indices=None):
+        self.total = total
+        self.bucket_count = bucket_count
+        self.latency = latency
+        self.indices = indices or []
+        self.recorded = {}
+        self.scripts = {}
+        self.requests = []
+        self.server = None
+        self.thread = None
+
+    @property
+    def host(self):
+        return self.server.server_address[0]
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self.server = StubHTTPServer(("127.0.0.1", 0), StubRequestHandler)
+        self.server.stub = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def handle(self, method, path, params, body):
+        self.requests.append((method, path, params, body))
+        if self.latency:
+            time.sleep(self.latency)
+
+        endpoint = path.rstrip("/").split("/")[-1]
+        if path.startswith("/_cat/indices"):
+            endpoint = "_cat/indices"
+        elif path.startswith("/_scripts/"):
+            endpoint = "_scripts"
+        elif path.endswith("/_search/template"):
+            endpoint = "_search/template"
+
+        if endpoint in self.recorded:
+            return 200, self.recorded[endpoint]
+
+        if endpoint == "_search":
+            return 200, self.search_response(json.loads(body) if body else {})
+        if endpoint == "_msearch":
+            lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+            return 200, {"responses": [self.search_response(search) for search in lines[1::2]]}
+        if endpoint == "_scripts" and method == "PUT":
+            self.scripts[path.split("/")[2]] = json.loads(body)["script"]["source"]
+            return 200, {"acknowledged": True}
+        if endpoint == "_search/template":
+            search = json.loads(body)
+            if search["id"] not in self.scripts:
+                return 404, {"error": {"type": "resource_not_found_exception", "reason": search["id"]}, "status": 404}
+            source = self.scripts[search["id"]]
+            for name, value in search.get("params", {}).items():
+                source = source.replace("{{%s}}" % name, json.dumps(value)[1:-1])
+            return 200, self.search_response(json.loads(source))
+        if endpoint == "_count":
+            return 200, {"count": self.total, "_shards": self.shards()}
+        if endpoint == "_cat/indices":
+            return 200, [{"index": index} for index in self.indices]
+
+        return 404, {"error": {"type": "stub_unsupported_endpoint", "reason": path}, "status": 404}
+
+    @staticmethod
+    def shards():
+        return {"total": 5, "successful": 5, "failed": 0}
+
+    def search_response(self, body):
+        response = {"took": 1,
+                    "timed_out": False,
+                    "_shards": self.shards(),
+                    "hits": {"total": self.total, "max_score": 0.0, "hits": []}}
+
+        if body.get("aggs"):
+            response["aggregations"] = self.aggregations(body["aggs"], self.total, body)
+
+        if body.get("profile"):
+            response["profile"] = self.profile(body)
+
+        return response
+
+    def profile(self, body):
+        # shard n spends n + 1 milliseconds in its boolean query, a tenth of it in each of two term queries
+        shards = []
+        for n in range(self.shards()["total"]):
+            nanos = (n + 1) * 1000000
+            query = {"type": "BooleanQuery", "description": "+level:error #@timestamp:[1516000000000 TO *]",
+                     "time_in_nanos": nanos,
+                     "children": [{"type": "TermQuery", "description": "level:error", "time_in_nanos": nanos // 10},
+                                  {"type": "PointRangeQuery", "description": "@timestamp:[1516000000000 TO *]",
+                                   "time_in_nanos": nanos // 10}]}
+            collector = {"name": "CancellableCollector", "reason": "search_cancelled", "time_in_nanos": nanos // 2,
+                         "children": [{"name": "TotalHitCountCollector", "reason": "search_count",
+                                       "time_in_nanos": nanos // 4}]}
+            shard = {"id": "[stub][logstash-2018.01.15][{}]".format(n),
+                     "searches": [{"query": [query], "rewrite_time": 1000, "collector": [collector]}],
+                     "aggregations": [{"type": "GlobalOrdinalsStringTermsAggregator", "description": name,
+                                       "time_in_nanos": nanos * 2} for name in body.get("aggs", {})]}
+            shards.append(shard)
+
+        return {"shards": shards}
+
+    def aggregations(self, aggs, doc_count, body):
+        return dict((name, self.aggregation(agg, doc_count, body)) for name, agg in aggs.items())
+
+    def aggregation(self, agg, doc_count, body):
+        agg_type = [key for key in agg if key not in ("aggs", "aggregations", "meta")][0]
+        params = agg[agg_type]
+        sub_aggs = agg.get("aggs") or agg.get("aggregations")
+
+        if agg_type == "filters":
+            return {"buckets": dict((key, self.bucket({}, doc_count // len(params["filters"]), sub_aggs, body))
+                                    for key in params["filters"])}
+
+        if agg_type == "date_histogram":
+            interval = int(params["interval"].rstrip("s")) * 1000
+            time_range = body["query"]["bool"]["filter"][1]["range"]["@timestamp"]["gte"]
+            start = time_range if isinstance(time_range, int) else int(time.time() * 1000) - interval
+            keys = list(range(start // interval * interval, int(time.time() * 1000) + 1, interval))
+            return {"buckets": [self.bucket({"key": key}, doc_count // len(keys), sub_aggs, body) for key in keys]}
+
+        if agg_type in ("sampler", "diversified_sampler"):
+            return self.bucket({}, min(doc_count, params.get("shard_size", 100) * self.shards()["total"]), sub_aggs, body)
+
+        # metric aggregations, a field whose values are spread evenly from 1 to 1000
+        if agg_type in ("avg", "max", "sum"):
+            return {"value": {"avg": 500.5, "max": 1000.0, "sum": 500.5 * doc_count}[agg_type] if doc_count else None}
+        if agg_type == "stats":
+            return {"count": doc_count, "min": 1.0 if doc_count else None, "max": 1000.0 if doc_count else None,
+                    "avg": 500.5 if doc_count else None, "sum": 500.5 * doc_count if doc_count else None}
+        if agg_type == "percentiles":
+            percents = params.get("percents", [1, 5, 25, 50, 75, 95, 99])
+            return {"values": dict((str(float(percent)), percent * 10.0 if doc_count else None) for percent in percents)}
+
+        if agg_type == "composite":
+            source = list(params["sources"][0])[0]
+            after = params.get("after", {}).get(source)
+            start = int(after.split("-")[1]) + 1 if after else 0
+            keys = ["key-{}".format(i) for i in range(start, min(start + params.get("size", 10), self.bucket_count))]
+            buckets = [self.bucket({"key": {source: key}}, max(1, doc_count // (2 ** min(int(key.split("-")[1]) + 1, 30))),
+                                   sub_aggs, body)
+                       for key in keys]
+
+            result = {"buckets": buckets}
+            if buckets:
+                result["after_key"] = buckets[-1]["key"]
+            return result
+
+        # terms like aggregations
+        keys = params.get("include") if isinstance(params.get("include"), list) else \
+            ["key-{}".format(i) for i in range(self.bucket_count)]
+        buckets = [self.bucket({"key": key}, max(1, doc_count // (2 ** min(i + 1, 30))), sub_aggs, body)
+                   for i, key in enumerate(keys)]
+
+        result = {"buckets": buckets}
+        if agg_type == "significant_terms":
+            result["doc_count"] = doc_count
+            result["bg_count"] = doc_count * 100
+            for bucket in buckets:
+                bucket.update({"score": 1.0, "bg_count": bucket["doc_count"] * 10})
+        else:
+            result.update({"doc_count_error_upper_bound": 0, "sum_other_doc_count": 0})
+
+        return result
+
+    def bucket(self, bucket, doc_count, sub_aggs, body):
+        bucket["doc_count"] = doc_count
+        if sub_aggs:
+            bucket.update(self.aggregations(sub_aggs, doc_count, body))
+        return bucket
+
+
+class StubHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # concurrent checks connect at once, a full listen backlog delays connections by a SYN retransmit (1s)
+    request_queue_size = 128
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, don't let them wait for delayed acks
+    disable_nagle_algorithm = True
+
+    def handle_any(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode("utf-8") if length else ""
+
+        status, response = self.server.stub.handle(self.command, url.path, parse_qs(url.query), body)
+
+        data = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_HEAD = handle_any
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,153 @@
+import pytest
+import sure
+
+import time
+import asyncio
+
+import check_elasticsearch_async
+import check_elasticsearch_metrics
+from check_elasticsearch_batch import CheckDefinition
+
+from tests.stub_elasticsearch import StubElasticsearch
+
+
+class TestRunChecks:
+    LATENCY = 0.2
+
+    @pytest.fixture
+    def es(self):
+        with StubElasticsearch(total=100, latency=self.LATENCY) as es:
+            yield es
+
+    def common_argv(self, es, tmpdir):
+        return ["--host", es.host, "--port", str(es.port), "--cache_dir", str(tmpdir), "--index_cache_ttl", "0"]
+
+    @staticmethod
+    def run(definitions, common_argv, max_connections):
+        async def collect():
+            return [result async for result in check_elasticsearch_async.run_checks(definitions, common_argv, max_connections)]
+
+        started = time.perf_counter()
+        results = asyncio.run(collect())
+        return results, time.perf_counter() - started
+
+    def test_checks_run_concurrently(self, es, tmpdir):
+        definitions = [CheckDefinition("web-{}".format(i), "errors", ["-q", "*", "-s", "600", "-c", "200", "-w", "50"])
+                       for i in range(8)]
+
+        results, elapsed = self.run(definitions, self.common_argv(es, tmpdir), max_connections=8)
+
+        sorted(definition.host_name for definition, _, _ in results).should.be.equal(
+            sorted(definition.host_name for definition in definitions))
+        set(alert_status for _, alert_status, _ in results).should.be.equal(
+            {check_elasticsearch_metrics.NagiosReturnCodes.WARNING.value})
+        elapsed.should.be.lower_than(self.LATENCY * 4)
+
+    def test_connections_capped_per_cluster(self, es, tmpdir):
+        definitions = [CheckDefinition("web-{}".format(i), "errors", ["-q", "*", "-s", "600", "-c", "200", "-w", "50"])
+                       for i in range(6)]
+
+        results, elapsed = self.run(definitions, self.common_argv(es, tmpdir), max_connections=2)
+
+        results.should.have.length_of(6)
+        elapsed.should.be.greater_than(self.LATENCY * 3)
+
+    def test_threaded_checks_capped_per_cluster(self, es, tmpdir):
+        definitions = [CheckDefinition("web-{}".format(i), "errors", ["-q", "*", "-s", "600", "-c", "200", "-w", "50",
+                                                                      "--incremental"])
+                       for i in range(6)]
+
+        results, elapsed = self.run(definitions, self.common_argv(es, tmpdir), max_connections=2)
+
+        results.should.have.length_of(6)
+        elapsed.should.be.greater_than(self.LATENCY * 3)
+
+    def test_errors_and_invalid_definitions(self, es, tmpdir):
+        definitions = [CheckDefinition("web-1", "broken", ["-q", "*"]),
+                       CheckDefinition("web-2", "down", ["-q", "*", "-s", "600", "-c", "200", "-w", "50", "--port", "1"])]
+
+        results, _ = self.run(definitions, self.common_argv(es, tmpdir), max_connections=2)
+
+        [alert_status for _, alert_status, _ in results].should.be.equal(
+            [check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value] * 2)
+
+    def test_search_template(self, es, tmpdir):
+        argv = ["-q", "*", "-s", "600", "-c", "200", "-w", "50", "--template", "all"]
+        check_elasticsearch_metrics.store_template(check_elasticsearch_metrics.parse_args(
+            self.common_argv(es, tmpdir) + argv + ["--fast_http"]))
+
+        results, _ = self.run([CheckDefinition("web-1", "all", argv)], self.common_argv(es, tmpdir), max_connections=2)
+
+        results[0][1].should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.WARNING.value)
+        es.requests[-1][1].should.match(r"/_search/template$")
+
+    def test_missing_indices_not_searched(self, es, tmpdir):
+        es.indices = ["logstash-2018.01.13"]
+        argv = ["-q", "*", "-s", "600", "-c", "200", "-w", "50", "-i", "3", "--index_cache_ttl", "300"]
+
+        results, _ = self.run([CheckDefinition("web-1", "errors", argv)], self.common_argv(es, tmpdir), max_connections=2)
+
+        results[0][1].should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.WARNING.value)
+        es.requests[0][1].should.match(r"^/_cat/indices/")
+        es.requests[1][1].should.match(r"^/logstash-\d{4}\.\d{2}\.\d{2}/_search$")
+
+    def test_failing_check_does_not_stop_the_others(self, es, tmpdir, monkeypatch):
+        run_check = check_elasticsearch_async.run_check
+
+        async def failing_run_check(args, client):
+            if args.query == "broken":
+                raise RuntimeError("boom")
+            return await run_check(args, client)
+
+        monkeypatch.setattr(check_elasticsearch_async, "run_check", failing_run_check)
+        definitions = [CheckDefinition("web-1", "broken", ["-q", "broken", "-s", "600", "-c", "200", "-w", "50"]),
+                       CheckDefinition("web-2", "errors", ["-q", "*", "-s", "600", "-c", "200", "-w", "50"])]
+
+        results, _ = self.run(definitions, self.common_argv(es, tmpdir), max_connections=2)
+
+        sorted((definition.host_name, alert_status, output) for definition, alert_status, output in results)[0] \
+            .should.be.equal(("web-1", check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value, "Check failed: boom"))
+        sorted(alert_status for _, alert_status, _ in results).should.be.equal(
+            [check_elasticsearch_metrics.NagiosReturnCodes.WARNING.value,
+             check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value])
+
+
+class TestAsyncHTTPClient:
+    RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: 2\r\n\r\n{}"
+
+    @staticmethod
+    def serve(handle, requests):
+        async def handle_connection(reader, writer):
+            while await reader.readline() not in (b"\r\n", b""):
+                pass
+            requests.append(writer)
+            writer.write(handle(len(requests)))
+            await writer.drain()
+            # keep-alive was never refused, yet the connection is closed after one response
+            writer.close()
+
+        return asyncio.start_server(handle_connection, "127.0.0.1", 0)
+
+    def requests(self, handle, count):
+        connections = []
+
+        async def send():
+            server = await self.serve(handle, connections)
+            client = check_elasticsearch_async.AsyncHTTPClient(*server.sockets[0].getsockname()[:2])
+            try:
+                return [await client.perform_request("GET", "/") for _ in range(count)]
+            finally:
+                client.close()
+                server.close()
+
+        return asyncio.run(send()), connections
+
+    def test_closed_keep_alive_connection_retried(self):
+        responses, connections = self.requests(lambda n: self.RESPONSE, 2)
+
+        responses.should.be.equal([{}, {}])
+        connections.should.have.length_of(2)
+
+    def test_malformed_status_line(self):
+        with pytest.raises(check_elasticsearch_metrics.QueryError):
+            self.requests(lambda n: b"garbage\r\n\r\n", 1)
@@ -0,0 +1,161 @@
+import pytest
+import sure
+
+import elasticsearch
+
+import check_elasticsearch_batch
+import check_elasticsearch_metrics
+
+
+class StubMultiSearchClient:
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def msearch(self, **kwargs):
+        self.requests.append(kwargs)
+        return {"responses": self.responses}
+
+
+class TestLoadDefinitions:
+
+    def test_text_file(self, tmpdir):
+        path = tmpdir.join("checks.txt")
+        path.write("# comment\n"
+                   "\n"
+                   "web-1;backend errors;-q 'level:ERROR AND program:backend' -s 600 -c 10 -w 5\n")
+
+        definitions = check_elasticsearch_batch.load_definitions(str(path))
+
+        definitions.should.be.equal([check_elasticsearch_batch.CheckDefinition(
+            "web-1", "backend errors", ["-q", "level:ERROR AND program:backend", "-s", "600", "-c", "10", "-w", "5"])])
+
+    def test_yaml_file(self, tmpdir):
+        path = tmpdir.join("checks.yml")
+        path.write("- host_name: web-1\n"
+                   "  service_description: backend errors\n"
+                   "  args: -q level:ERROR -s 600 -c 10 -w 5\n"
+                   "- host_name: web-2\n"
+                   "  service_description: backend warnings\n"
+                   "  args: [-q, 'level:WARN', -s, 600, -c, 10, -w, 5]\n")
+
+        definitions = check_elasticsearch_batch.load_definitions(str(path))
+
+        definitions.should.have.length_of(2)
+        definitions[0].argv.should.be.equal(["-q", "level:ERROR", "-s", "600", "-c", "10", "-w", "5"])
+        definitions[1].argv.should.be.equal(["-q", "level:WARN", "-s", "600", "-c", "10", "-w", "5"])
+
+
+class TestRunBatch:
+    COMMON_ARGV = ["--host", "test.me", "--index_cache_ttl", "0"]
+
+    def test_single_msearch_per_cluster(self):
+        client = StubMultiSearchClient([
+            {"hits": {"total": 3, "max_score": 0.0, "hits": []}},
+            {"hits": {"total": 30, "max_score": 0.0, "hits": []}},
+            {"error": {"type": "index_not_found_exception"}},
+        ])
+        definitions = [
+            check_elasticsearch_batch.CheckDefinition("web-1", "errors", ["-q", "level:ERROR", "-s", "600", "-c", "20", "-w", "10"]),
+            check_elasticsearch_batch.CheckDefinition("web-1", "warnings", ["-q", "level:WARN", "-s", "60", "-c", "20", "-w", "10"]),
+            check_elasticsearch_batch.CheckDefinition("web-2", "missing", ["-q", "*", "-s", "60", "-c", "20", "-w", "10"]),
+            check_elasticsearch_batch.CheckDefinition("web-3", "broken", ["-q", "*"]),
+        ]
+
+        results = check_elasticsearch_batch.run_batch(definitions, self.COMMON_ARGV, get_client=lambda host, port: client)
+
+        client.requests.should.have.length_of(1)
+        client.requests[0]["body"].should.have.length_of(6)
+        client.requests[0]["body"][1]["query"]["bool"]["filter"][0]["query_string"]["query"].should.be.equal("level:ERROR")
+        client.requests[0]["body"][3]["query"]["bool"]["filter"][0]["query_string"]["query"].should.be.equal("level:WARN")
+
+        [alert_status for _, alert_status, _ in results].should.be.equal([
+            check_elasticsearch_metrics.NagiosReturnCodes.OK.value,
+            check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value,
+            check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value,
+            check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value,
+        ])
+
+    def test_composite_checks_run_on_their_own(self):
+        client = StubMultiSearchClient([{"hits": {"total": 3, "max_score": 0.0, "hits": []}}])
+        client.search = lambda **kwargs: {"hits": {"total": 40, "hits": []},
+                                          "aggregations": {"hosts": {"buckets": [{"key": {"hosts": "web-1"}, "doc_count": 40}]}}}
+        definitions = [
+            check_elasticsearch_batch.CheckDefinition("web-1", "errors", ["-q", "level:ERROR", "-s", "600", "-c", "20", "-w", "10"]),
+            check_elasticsearch_batch.CheckDefinition("web-1", "hosts", ["-q", "*", "-s", "600", "-c", "20", "-w", "10",
+                                                                         "--aggregation_name", "hosts",
+                                                                         "--aggregation_type", "composite",
+                                                                         "--aggregation_field", "host.raw"]),
+        ]
+
+        results = check_elasticsearch_batch.run_batch(definitions, self.COMMON_ARGV, get_client=lambda host, port: client)
+
+        client.requests[0]["body"].should.have.length_of(2)
+        [alert_status for _, alert_status, _ in results].should.be.equal([
+            check_elasticsearch_metrics.NagiosReturnCodes.OK.value,
+            check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value,
+        ])
+
+    def test_incremental_checks_run_on_their_own(self, tmpdir):
+        client = StubMultiSearchClient([{"hits": {"total": 3, "max_score": 0.0, "hits": []}}])
+        client.search = lambda **kwargs: {"hits": {"total": 40, "hits": []},
+                                          "aggregations": {"incremental": {"buckets": [{"key": 0, "doc_count": 40}]}}}
+        definitions = [
+            check_elasticsearch_batch.CheckDefinition("web-1", "errors", ["-q", "level:ERROR", "-s", "600", "-c", "20", "-w", "10"]),
+            check_elasticsearch_batch.CheckDefinition("web-1", "all", ["-q", "*", "-s", "600", "-c", "20", "-w", "10",
+                                                                       "--incremental", "--cache_dir", str(tmpdir)]),
+        ]
+
+        results = check_elasticsearch_batch.run_batch(definitions, self.COMMON_ARGV, get_client=lambda host, port: client)
+
+        client.requests[0]["body"].should.have.length_of(2)
+        [alert_status for _, alert_status, _ in results].should.be.equal([
+            check_elasticsearch_metrics.NagiosReturnCodes.OK.value,
+            check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value,
+        ])
+
+    def test_template_checks_run_on_their_own(self):
+        client = StubMultiSearchClient([{"hits": {"total": 3, "max_score": 0.0, "hits": []}}])
+        client.search_template = lambda **kwargs: {"hits": {"total": 40, "hits": []}}
+        definitions = [
+            check_elasticsearch_batch.CheckDefinition("web-1", "errors", ["-q", "level:ERROR", "-s", "600", "-c", "20", "-w", "10"]),
+            check_elasticsearch_batch.CheckDefinition("web-1", "all", ["-q", "*", "-s", "600", "-c", "20", "-w", "10",
+                                                                       "--template", "all"]),
+            check_elasticsearch_batch.CheckDefinition("web-1", "store", ["-q", "*", "-s", "600", "-c", "20", "-w", "10",
+                                                                         "--template", "all", "--store_template"]),
+        ]
+
+        results = check_elasticsearch_batch.run_batch(definitions, self.COMMON_ARGV, get_client=lambda host, port: client)
+
+        client.requests[0]["body"].should.have.length_of(2)
+        [alert_status for _, alert_status, _ in results].should.be.equal([
+            check_elasticsearch_metrics.NagiosReturnCodes.OK.value,
+            check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value,
+            check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value,
+        ])
+
+    def test_unreachable_cluster(self, tmpdir):
+        class UnreachableCat:
+            def indices(self, **kwargs):
+                raise elasticsearch.exceptions.ConnectionError("N/A", "connection refused", None)
+
+        client = StubMultiSearchClient([])
+        client.cat = UnreachableCat()
+        definitions = [
+            check_elasticsearch_batch.CheckDefinition("web-1", "errors", ["-q", "level:ERROR", "-s", "600", "-c", "20", "-w", "10"]),
+            check_elasticsearch_batch.CheckDefinition("web-2", "errors", ["-q", "level:ERROR", "-s", "600", "-c", "20", "-w", "10"]),
+        ]
+
+        results = check_elasticsearch_batch.run_batch(definitions, ["--host", "test.me", "--cache_dir", str(tmpdir)],
+                                                      get_client=lambda host, port: client)
+
+        client.requests.should.be.empty
+        [alert_status for _, alert_status, _ in results].should.be.equal(
+            [check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value] * 2)
+        results[0][2].should.match(r"^Got elasticsearch exception: .*connection refused")
+
+    def test_format_passive_result(self):
+        definition = check_elasticsearch_batch.CheckDefinition("web-1", "errors", [])
+
+        line = check_elasticsearch_batch.format_passive_result(definition, 1, "Current Value: 7", 1516000000.5)
+        line.should.be.equal("[1516000000] PROCESS_SERVICE_CHECK_RESULT;web-1;errors;1;Current Value: 7\n")
@@ -0,0 +1,79 @@
+import pytest
+import sure
+
+import os
+import stat
+import threading
+
+import check_elasticsearch_client
+import check_elasticsearch_daemon
+import check_elasticsearch_metrics
+
+from tests.stub_elasticsearch import StubElasticsearch
+from tests.test_check_elasticsearch_metrics import StubElasticsearchClient
+
+
+class TestCheckDaemon:
+    CHECK_ARGS = ["--host", "test.me",
+                  "--critical", "10",
+                  "--warning", "5",
+                  "--seconds", "600",
+                  "--query", "test",
+                  "--index_cache_ttl", "0"]
+
+    @pytest.fixture
+    def server(self, tmpdir):
+        server = check_elasticsearch_daemon.CheckServer(str(tmpdir.join("check.sock")), cache_dir=str(tmpdir.join("cache")))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        yield server
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    def test_check_uses_pooled_client(self, server):
+        client = StubElasticsearchClient({"hits": {"total": 7, "max_score": 0.0, "hits": []}})
+        server.clients[("test.me", 9200)] = client
+
+        for _ in range(2):
+            alert_status, output = check_elasticsearch_client.request_check(server.server_address, self.CHECK_ARGS)
+            alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.WARNING.value)
+            output.should.match(r"Current Value: 7,")
+
+        client.requests.should.have.length_of(2)
+
+    def test_argument_error(self, server):
+        alert_status, output = check_elasticsearch_client.request_check(server.server_address, ["--host", "test.me"])
+
+        alert_status.should.be.equal(2)
+        output.should.match(r"the following arguments are required")
+
+    def test_version(self, server):
+        alert_status, output = check_elasticsearch_client.request_check(server.server_address, ["--version"])
+
+        alert_status.should.be.equal(0)
+        output.should.match(check_elasticsearch_metrics.version)
+
+    def test_socket_only_for_its_user(self, server):
+        stat.S_IMODE(os.stat(server.server_address).st_mode).should.be.equal(0o600)
+
+    def test_cache_dir_refused(self, server, tmpdir):
+        for argv in (["--cache_dir", str(tmpdir.join("elsewhere"))], ["--cache_d=" + str(tmpdir.join("elsewhere"))]):
+            alert_status, output = check_elasticsearch_client.request_check(server.server_address, self.CHECK_ARGS + argv)
+
+            alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value)
+            output.should.match(r"--cache_dir can't be set")
+        tmpdir.join("elsewhere").exists().should.be.equal(False)
+
+    def test_store_template_and_profile(self, server):
+        with StubElasticsearch() as es:
+            argv = self.CHECK_ARGS + ["--host", es.host, "--port", str(es.port), "--template", "errors"]
+
+            alert_status, output = check_elasticsearch_client.request_check(server.server_address,
+                                                                            argv + ["--store_template"])
+            alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.OK.value)
+            output.should.be.equal("Stored the search template errors")
+            es.scripts.should.have.key("errors")
+
+            alert_status, output = check_elasticsearch_client.request_check(server.server_address, argv + ["--profile"])
+            output.should.match(r"^Profile of the check search on ")
@@ -1,16 +1,52 @@
 import pytest
 import sure
 
+import os
+import sys
+import json
+import time
 import argparse
 import datetime
+import collections
+import subprocess
+
+import elasticsearch
 
 import check_elasticsearch_metrics
 
+from tests.stub_elasticsearch import StubElasticsearch
+
+
+@pytest.fixture
+def stub_options():
+    return {"total": 1000, "bucket_count": 3}
+
+
+@pytest.fixture
+def es(stub_options):
+    with StubElasticsearch(**stub_options) as es:
+        yield es
+
+
+def check_argv(es, tmpdir, *argv):
+    return ["--host", es.host, "--port", str(es.port), "--cache_dir", str(tmpdir)] + list(argv)
+
+
+def run_main(*argv):
+    with pytest.raises(SystemExit) as e:
+        check_elasticsearch_metrics.main(list(argv))
+    return e.value.code
+
+
+def searches(es):
+    # index pruning looks up the existing indices before searching
+    return [request for request in es.requests if not request[1].startswith("/_cat/")]
+
 
 class TestBuildIndices:
     class StubDatetime:
         @staticmethod
-        def now():
+        def utcnow():
             return datetime.datetime(2018, 1, 15)
 
     @pytest.fixture(scope="class")
@@ -48,6 +84,104 @@ class TestBuildIndices:
         index = check_elasticsearch_metrics.build_indices(indices_count=1, index_pattern="pattern-{prefix}", index_prefix="xxx")
         index.should.be.equal("pattern-xxx")
 
+    def test_hourly_pattern_rejected(self):
+        with pytest.raises(SystemExit):
+            check_elasticsearch_metrics.parse_args(["--host", "test.me", "-c", "10", "-w", "5", "-s", "600", "-q", "*",
+                                                    "-i", "2", "-n", "{prefix}-{yyyy}.{mm}.{dd}.{hh}"])
+
+
+class TestBuildIndicesForWindow:
+    class StubDatetime:
+        @staticmethod
+        def now():
+            # local time east of UTC, the indices are named after the UTC date
+            return datetime.datetime(2018, 1, 15, 2, 5)
+
+        @staticmethod
+        def utcnow():
+            return datetime.datetime(2018, 1, 15, 0, 5)
+
+    @pytest.fixture(scope="class")
+    def mock_datetime(self):
+        check_elasticsearch_metrics.datetime = self.StubDatetime
+        yield 1
+        check_elasticsearch_metrics.datetime = datetime.datetime
+
+    def test_window_within_one_day(self, mock_datetime):
+        index = check_elasticsearch_metrics.build_indices(seconds=60)
+        index.should.be.equal("logstash-2018.01.15")
+
+    def test_window_crosses_midnight(self, mock_datetime):
+        index = check_elasticsearch_metrics.build_indices(seconds=600)
+        index.should.be.equal("logstash-2018.01.15,logstash-2018.01.14")
+
+    def test_window_several_days(self, mock_datetime):
+        index = check_elasticsearch_metrics.build_indices(seconds=2 * 24 * 3600)
+        index.should.be.equal("logstash-2018.01.15,logstash-2018.01.14,logstash-2018.01.13")
+
+    def test_hourly_pattern(self, mock_datetime):
+        index = check_elasticsearch_metrics.build_indices(index_pattern="{prefix}-{yyyy}.{mm}.{dd}.{hh}", seconds=3600)
+        index.should.be.equal("logstash-2018.01.15.00,logstash-2018.01.14.23")
+
+    def test_monthly_pattern(self, mock_datetime):
+        index = check_elasticsearch_metrics.build_indices(index_pattern="metrics-{yyyy}.{mm}", seconds=600)
+        index.should.be.equal("metrics-2018.01")
+
+        index = check_elasticsearch_metrics.build_indices(index_pattern="metrics-{yyyy}.{mm}", seconds=20 * 24 * 3600)
+        index.should.be.equal("metrics-2018.01,metrics-2017.12")
+
+    def test_constant_pattern(self, mock_datetime):
+        index = check_elasticsearch_metrics.build_indices(index_pattern="const", seconds=10 * 24 * 3600)
+        index.should.be.equal("const")
+
+
+class TestPruneMissingIndices:
+    class StubCat:
+        def __init__(self, indices):
+            self.indices_list = indices
+            self.calls = 0
+
+        def indices(self, **kwargs):
+            self.calls += 1
+            return [{"index": index} for index in self.indices_list]
+
+    class StubClient:
+        def __init__(self, cat):
+            self.cat = cat
+
+    @staticmethod
+    def make_args(cache_dir, ttl=300):
+        return argparse.Namespace(host="test.me", port=9200, cache_dir=str(cache_dir), index_cache_ttl=ttl,
+                                  index_pattern="{prefix}-{yyyy}.{mm}.{dd}", index_prefix="logstash", breaker_failures=0)
+
+    def test_missing_indices_dropped(self, tmpdir):
+        cat = self.StubCat(["logstash-2018.01.15", "logstash-2018.01.13"])
+        args = self.make_args(tmpdir)
+
+        index = check_elasticsearch_metrics.prune_missing_indices(
+            self.StubClient(cat), args, "logstash-2018.01.15,logstash-2018.01.14,logstash-2018.01.13")
+        index.should.be.equal("logstash-2018.01.15,logstash-2018.01.13")
+
+    def test_newest_index_always_kept(self, tmpdir):
+        cat = self.StubCat(["logstash-2018.01.14"])
+        args = self.make_args(tmpdir)
+
+        index = check_elasticsearch_metrics.prune_missing_indices(
+            self.StubClient(cat), args, "logstash-2018.01.15,logstash-2018.01.14")
+        index.should.be.equal("logstash-2018.01.15,logstash-2018.01.14")
+
+    def test_existing_indices_cached(self, tmpdir):
+        cat = self.StubCat(["logstash-2018.01.15"])
+        args = self.make_args(tmpdir)
+
+        check_elasticsearch_metrics.prune_missing_indices(self.StubClient(cat), args, "logstash-2018.01.15")
+        check_elasticsearch_metrics.prune_missing_indices(self.StubClient(cat), args, "logstash-2018.01.15")
+        cat.calls.should.be.equal(1)
+
+        args.index_cache_ttl = -1
+        check_elasticsearch_metrics.prune_missing_indices(self.StubClient(cat), args, "logstash-2018.01.15")
+        cat.calls.should.be.equal(2)
+
 
 # class TestParseArgs:
 #     def test(self):
@@ -139,6 +273,7 @@ class TestHandleElasticResponse:
         args = argparse.Namespace(aggregation_name="elastic-plugin-tests",
                                   aggregation_type="significant_terms",
                                   aggregation_field="level.raw",
+                                  sample_size=None,
                                   **request.param['args'])
         request.param["args"] = args
 
@@ -229,6 +364,73 @@ class TestHandleElasticResponse:
         result = check_elasticsearch_metrics.handle_elastic_response(args, response)
         result.should.be.equal(expected_result)
 
+    def test_terms_aggregation(self):
+        args = argparse.Namespace(aggregation_name="codes",
+                                  aggregation_type="terms",
+                                  aggregation_field="response",
+                                  aggregation_result_bucket_key=["500", "502"],
+                                  aggregation_result_type="percentage",
+                                  sample_size=None)
+        response = Stub({
+            "hits": {"total": 400},
+            "aggregations": {
+                "codes": {
+                    "doc_count_error_upper_bound": 0,
+                    "sum_other_doc_count": 0,
+                    "buckets": [Stub({"key": 500, "doc_count": 30}), Stub({"key": 502, "doc_count": 10})]
+                }
+            }
+        })
+
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(10.0)
+
+        args.aggregation_result_type = "count"
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(40)
+
+    def test_filters_aggregation(self):
+        args = argparse.Namespace(aggregation_name="levels",
+                                  aggregation_type="filters",
+                                  aggregation_field="level.raw",
+                                  aggregation_result_bucket_key=["WARN", "ERROR"],
+                                  aggregation_result_type="percentage",
+                                  sample_size=None)
+        response = Stub({
+            "hits": {"total": 200},
+            "aggregations": {
+                "levels": {
+                    "buckets": {"WARN": {"doc_count": 20}, "ERROR": {"doc_count": 5}}
+                }
+            }
+        })
+
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(12.5)
+
+        args.aggregation_result_type = "count"
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(25)
+
+    def test_composite_aggregation_is_streamed(self):
+        args = argparse.Namespace(aggregation_name="hosts",
+                                  aggregation_type="composite",
+                                  aggregation_field="host.raw",
+                                  aggregation_result_bucket_key=["web-2"],
+                                  aggregation_result_type="count",
+                                  sample_size=None)
+        consumed = []
+
+        def buckets():
+            for i, doc_count in enumerate([5, 40, 15]):
+                consumed.append(i)
+                yield {"key": {"hosts": "web-{}".format(i)}, "doc_count": doc_count}
+
+        response = {"hits": {"total": 60}, "aggregations": {"hosts": {"buckets": buckets()}}}
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(15)
+        consumed.should.be.equal([0, 1, 2])
+
+        # without bucket keys the largest bucket is read
+        args.aggregation_result_bucket_key = None
+        response = {"hits": {"total": 60}, "aggregations": {"hosts": {"buckets": buckets()}}}
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(40)
+
     def test_aggregation_result_bucket_key_special(self, aggregation_range_bucket_key_fixture):
         req_params = aggregation_range_bucket_key_fixture
         args = req_params["args"]
@@ -363,6 +565,1071 @@ class TestGetAlertStatus:
         alert_status = check_elasticsearch_metrics.get_alert_status(args, value=15.1)
         alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value)
 
+class StubElasticsearchClient:
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def search(self, **kwargs):
+        self.requests.append(kwargs)
+        return self.response
+
+
+class TestExecuteElasticQuery:
+    @staticmethod
+    def make_args(**kwargs):
+        params = dict(query="level:ERROR",
+                      seconds=600,
+                      host="test.me",
+                      port=9200,
+                      indices_count=1,
+                      index_pattern="const",
+                      index_prefix="logstash",
+                      aggregation_name=None,
+                      aggregation_type=None,
+                      aggregation_field=None,
+                      aggregation_result_bucket_key=None,
+                      aggregation_result_type="count",
+                      time_rounding=None,
+                      request_cache=False,
+                      index_cache_ttl=0,
+                      incremental=False,
+                      budget_ms=None,
+                      terminate_after=None,
+                      partial_result="lower_bound",
+                      last_value_max_age=3600,
+                      fast_http=False,
+                      result_cache_ttl=0,
+                      composite_page_size=1000,
+                      per_bucket=False,
+                      breaker_failures=0,
+                      sample_size=None,
+                      sample_diversify_field=None,
+                      template=None,
+                      baseline=None)
+        params.update(kwargs)
+        return argparse.Namespace(**params)
+
+    def test_query_in_filter_context(self):
+        s = check_elasticsearch_metrics.build_search(self.make_args())
+
+        s.to_dict().should.be.equal({
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"query_string": {"query": "level:ERROR", "analyze_wildcard": True}},
+                        {"range": {"@timestamp": {"gte": "now-600s"}}}
+                    ]
+                }
+            },
+            "size": 0
+        })
+
+    def test_time_rounding(self):
+        s = check_elasticsearch_metrics.build_search(self.make_args(time_rounding="m"))
+
+        s.to_dict()["query"]["bool"]["filter"][1].should.be.equal({"range": {"@timestamp": {"gte": "now-600s/m"}}})
+
+    def test_terms_aggregation_limited_to_bucket_keys(self):
+        s = check_elasticsearch_metrics.build_search(self.make_args(aggregation_name="codes",
+                                                                    aggregation_type="terms",
+                                                                    aggregation_field="response",
+                                                                    aggregation_result_bucket_key=["500", "501", "502"]))
+
+        s.to_dict()["aggs"].should.be.equal({"codes": {"terms": {"field": "response",
+                                                                 "include": ["500", "501", "502"],
+                                                                 "size": 3}}})
+
+    def test_filters_aggregation(self):
+        s = check_elasticsearch_metrics.build_search(self.make_args(aggregation_name="levels",
+                                                                    aggregation_type="filters",
+                                                                    aggregation_field="level.raw",
+                                                                    aggregation_result_bucket_key=["WARN", "ERROR"]))
+
+        s.to_dict()["aggs"].should.be.equal({"levels": {"filters": {"filters": {
+            "WARN": {"term": {"level.raw": "WARN"}},
+            "ERROR": {"term": {"level.raw": "ERROR"}}
+        }}}})
+
+    def test_filters_aggregation_requires_bucket_keys(self):
+        with pytest.raises(SystemExit):
+            check_elasticsearch_metrics.parse_args(["--host", "test.me", "-c", "10", "-w", "5", "-s", "600", "-q", "*",
+                                                    "--aggregation_name", "levels",
+                                                    "--aggregation_type", "filters",
+                                                    "--aggregation_field", "level.raw"])
+
+    def test_request_cache(self):
+        client = StubElasticsearchClient({"hits": {"total": 0, "max_score": 0.0, "hits": []}})
+
+        check_elasticsearch_metrics.execute_elastic_query(self.make_args(), client=client)
+        client.requests[-1].shouldnt.have.key("request_cache")
+
+        check_elasticsearch_metrics.execute_elastic_query(self.make_args(request_cache=True), client=client)
+        client.requests[-1]["request_cache"].should.be.equal(True)
+
+    def test_latency_budget(self):
+        client = StubElasticsearchClient({"hits": {"total": 0, "max_score": 0.0, "hits": []}})
+
+        check_elasticsearch_metrics.execute_elastic_query(self.make_args(budget_ms=1000, terminate_after=10000), client=client)
+
+        client.requests[-1]["request_timeout"].should.be.equal(1.0)
+        client.requests[-1]["body"]["timeout"].should.be.equal("750ms")
+        client.requests[-1]["body"]["terminate_after"].should.be.equal(10000)
+
+    def test_terminate_after_ignored_for_aggregations(self):
+        s = check_elasticsearch_metrics.build_search(self.make_args(terminate_after=10000,
+                                                                    aggregation_name="levels",
+                                                                    aggregation_type="significant_terms",
+                                                                    aggregation_field="level.raw",
+                                                                    aggregation_result_bucket_key=None))
+
+        s.to_dict().shouldnt.have.key("terminate_after")
+
+    def test_count_only_requests_no_hits(self):
+        client = StubElasticsearchClient({"hits": {"total": 42, "max_score": 0.0, "hits": []}})
+        args = self.make_args()
+
+        response = check_elasticsearch_metrics.execute_elastic_query(args, client=client)
+
+        client.requests.should.have.length_of(1)
+        client.requests[0]["index"].should.be.equal("const")
+        client.requests[0]["body"]["size"].should.be.equal(0)
+        client.requests[0]["body"].shouldnt.have.key("aggs")
+        response["hits"]["hits"].should.be.equal([])
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(42)
+
+    def test_aggregation_requests_no_hits(self):
+        client = StubElasticsearchClient({
+            "hits": {"total": 10, "max_score": 0.0, "hits": []},
+            "aggregations": {"levels": {"doc_count": 10, "buckets": [{"key": "WARN", "doc_count": 4}]}}
+        })
+        args = self.make_args(aggregation_name="levels",
+                              aggregation_type="significant_terms",
+                              aggregation_field="level.raw",
+                              aggregation_result_bucket_key=["WARN"],
+                              aggregation_result_type="count")
+
+        response = check_elasticsearch_metrics.execute_elastic_query(args, client=client)
+
+        body = client.requests[0]["body"]
+        body["size"].should.be.equal(0)
+        body["aggs"].should.be.equal({"levels": {"significant_terms": {"field": "level.raw"}}})
+        response["hits"]["hits"].should.be.equal([])
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(4)
+
+
+class TestIncrementalQuery:
+    NOW = 1516000000
+
+    class StubClient:
+        def __init__(self):
+            self.responses = []
+            self.requests = []
+
+        def search(self, **kwargs):
+            self.requests.append(kwargs)
+            return self.responses.pop(0)
+
+    @staticmethod
+    def histogram_response(buckets):
+        return {"hits": {"total": sum(b["doc_count"] for b in buckets), "max_score": 0.0, "hits": []},
+                "aggregations": {check_elasticsearch_metrics.INCREMENTAL_AGGREGATION: {"buckets": buckets}}}
+
+    @staticmethod
+    def make_args(cache_dir, **kwargs):
+        return TestExecuteElasticQuery.make_args(incremental=True, bucket_interval=60, seconds=180,
+                                                 cache_dir=str(cache_dir), **kwargs)
+
+    def gte(self, request):
+        return request["body"]["query"]["bool"]["filter"][1]["range"]["@timestamp"]["gte"]
+
+    def test_only_new_buckets_fetched(self, tmpdir, monkeypatch):
+        client = self.StubClient()
+        args = self.make_args(tmpdir)
+        minute = 60 * 1000
+        now = self.NOW * 1000 // minute * minute
+
+        monkeypatch.setattr(check_elasticsearch_metrics.time, "time", lambda: self.NOW)
+        client.responses.append(self.histogram_response([{"key": now - 3 * minute, "doc_count": 1},
+                                                         {"key": now - 2 * minute, "doc_count": 2},
+                                                         {"key": now - minute, "doc_count": 3},
+                                                         {"key": now, "doc_count": 4}]))
+        response = check_elasticsearch_metrics.execute_elastic_query(args, client=client)
+
+        self.gte(client.requests[-1]).should.be.equal(now - 3 * minute)
+        client.requests[-1]["body"]["aggs"][check_elasticsearch_metrics.INCREMENTAL_AGGREGATION]["date_histogram"]["interval"] \
+            .should.be.equal("60s")
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(10)
+
+        # a minute later: the first bucket slid out of the window, only the last closed and the open one are fetched
+        monkeypatch.setattr(check_elasticsearch_metrics.time, "time", lambda: self.NOW + 60)
+        client.responses.append(self.histogram_response([{"key": now - minute, "doc_count": 5},
+                                                         {"key": now, "doc_count": 6},
+                                                         {"key": now + minute, "doc_count": 7}]))
+        response = check_elasticsearch_metrics.execute_elastic_query(args, client=client)
+
+        self.gte(client.requests[-1]).should.be.equal(now - minute)
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(2 + 5 + 6 + 7)
+
+    def test_bucket_keys_cached_apart(self, tmpdir, monkeypatch):
+        client = self.StubClient()
+        minute = 60 * 1000
+        now = self.NOW * 1000 // minute * minute
+
+        monkeypatch.setattr(check_elasticsearch_metrics.time, "time", lambda: self.NOW)
+        for key, doc_count in (("ERROR", 4), ("WARN", 7)):
+            args = self.make_args(tmpdir, aggregation_name="levels", aggregation_type="filters",
+                                  aggregation_field="level.raw", aggregation_result_bucket_key=[key])
+            client.responses.append(self.histogram_response([
+                {"key": now - 2 * minute, "doc_count": 10, "levels": {"buckets": {key: {"doc_count": doc_count}}}}]))
+            check_elasticsearch_metrics.execute_elastic_query(args, client=client)
+
+        monkeypatch.setattr(check_elasticsearch_metrics.time, "time", lambda: self.NOW + 60)
+        client.responses.append(self.histogram_response([]))
+        response = check_elasticsearch_metrics.execute_elastic_query(args, client=client)
+
+        # the WARN check only reads its own intervals
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(7)
+        tmpdir.listdir(lambda path: path.basename.startswith("buckets-")).should.have.length_of(2)
+
+    def test_partial_response_not_cached(self, tmpdir, monkeypatch):
+        client = self.StubClient()
+        args = self.make_args(tmpdir)
+        minute = 60 * 1000
+        now = self.NOW * 1000 // minute * minute
+
+        monkeypatch.setattr(check_elasticsearch_metrics.time, "time", lambda: self.NOW)
+        response = self.histogram_response([{"key": now - 3 * minute, "doc_count": 1}])
+        response["timed_out"] = True
+        client.responses.append(response)
+        check_elasticsearch_metrics.execute_elastic_query(args, client=client)
+
+        # the timed out search is not trusted, the whole window is fetched again
+        monkeypatch.setattr(check_elasticsearch_metrics.time, "time", lambda: self.NOW + 60)
+        client.responses.append(self.histogram_response([{"key": now - 2 * minute, "doc_count": 5}]))
+        response = check_elasticsearch_metrics.execute_elastic_query(args, client=client)
+
+        self.gte(client.requests[-1]).should.be.equal(now - 2 * minute)
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(5)
+
+    def test_aggregation_buckets_summed(self, tmpdir, monkeypatch):
+        client = self.StubClient()
+        args = self.make_args(tmpdir,
+                              aggregation_name="levels",
+                              aggregation_type="significant_terms",
+                              aggregation_field="level.raw",
+                              aggregation_result_bucket_key=None,
+                              aggregation_result_type="count")
+        minute = 60 * 1000
+        now = self.NOW * 1000 // minute * minute
+
+        monkeypatch.setattr(check_elasticsearch_metrics.time, "time", lambda: self.NOW)
+        client.responses.append(self.histogram_response([
+            {"key": now - minute, "doc_count": 10,
+             "levels": {"doc_count": 10, "buckets": [{"key": "WARN", "doc_count": 3}, {"key": "ERROR", "doc_count": 1}]}},
+            {"key": now, "doc_count": 20,
+             "levels": {"doc_count": 20, "buckets": [{"key": "ERROR", "doc_count": 5}]}},
+        ]))
+        response = check_elasticsearch_metrics.execute_elastic_query(args, client=client)
+
+        client.requests[-1]["body"]["aggs"][check_elasticsearch_metrics.INCREMENTAL_AGGREGATION]["aggs"] \
+            .should.be.equal({"levels": {"significant_terms": {"field": "level.raw"}}})
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(6)
+
+        args.aggregation_result_bucket_key = ["WARN"]
+        args.aggregation_result_type = "percentage"
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(10.0)
+
+
+class TestPerfdata:
+
+    def test_format_perfdata(self):
+        check_elasticsearch_metrics.format_perfdata("value", 12, warning=2.0, critical=15.0).should.be.equal("value=12;2.0;15.0;;")
+        check_elasticsearch_metrics.format_perfdata("time_request", 0.0123456789, uom="s").should.be.equal("time_request=0.012346s;;;;")
+
+    def test_status_line_has_perfdata(self):
+        client = StubElasticsearchClient({"took": 3,
+                                          "timed_out": False,
+                                          "_shards": {"total": 5, "successful": 5, "failed": 0},
+                                          "hits": {"total": 42, "max_score": 0.0, "hits": []}})
+        args = TestExecuteElasticQuery.make_args(critical=10.0, warning=5.0, reverse=False)
+        timings = collections.OrderedDict()
+
+        alert_status, output = check_elasticsearch_metrics.run_check(args, client=client, timings=timings)
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value)
+        list(timings.keys()).should.be.equal(["build", "request", "handle"])
+
+        status, perfdata = output.split(" | ")
+        status.should.be.equal("Exited with: 2, Current Value: 42, Critical: 10.0, Warning: 5.0")
+        perfdata = perfdata.split(" ")
+        perfdata[0].should.be.equal("value=42;5.0;10.0;;")
+        [item.split("=")[0] for item in perfdata[1:5]].should.be.equal(["time_build", "time_request", "time_handle", "time_total"])
+        perfdata[5:].should.be.equal(["es_took=3ms;;;;", "es_timed_out=0;;;;", "es_shards_total=5;;;;", "es_shards_failed=0;;;;"])
+
+
+class TestPartialResult:
+    PARTIAL = {"took": 750, "timed_out": True, "_shards": {"total": 5, "successful": 5, "failed": 0},
+               "hits": {"total": 3, "max_score": 0.0, "hits": []}}
+    COMPLETE = {"took": 5, "timed_out": False, "_shards": {"total": 5, "successful": 5, "failed": 0},
+                "hits": {"total": 12, "max_score": 0.0, "hits": []}}
+
+    class FailingClient:
+        def search(self, **kwargs):
+            raise elasticsearch.exceptions.ConnectionTimeout("TIMEOUT", "timed out", None)
+
+    @staticmethod
+    def make_args(tmpdir, policy):
+        return TestExecuteElasticQuery.make_args(critical=10.0, warning=5.0, reverse=False, partial_result=policy,
+                                                 cache_dir=str(tmpdir))
+
+    def test_lower_bound(self, tmpdir):
+        alert_status, output = check_elasticsearch_metrics.run_check(self.make_args(tmpdir, "lower_bound"),
+                                                                     client=StubElasticsearchClient(self.PARTIAL))
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.OK.value)
+        output.should.match(r"Current Value: 3,")
+
+    def test_unknown(self, tmpdir):
+        alert_status, _ = check_elasticsearch_metrics.run_check(self.make_args(tmpdir, "unknown"),
+                                                                client=StubElasticsearchClient(self.PARTIAL))
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value)
+
+    def test_last_value(self, tmpdir):
+        args = self.make_args(tmpdir, "last_value")
+
+        alert_status, _ = check_elasticsearch_metrics.run_check(args, client=StubElasticsearchClient(self.PARTIAL))
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value)
+
+        alert_status, _ = check_elasticsearch_metrics.run_check(args, client=StubElasticsearchClient(self.COMPLETE))
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value)
+
+        alert_status, output = check_elasticsearch_metrics.run_check(args, client=StubElasticsearchClient(self.PARTIAL))
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value)
+        output.should.match(r"Current Value: 12,")
+
+        alert_status, output = check_elasticsearch_metrics.run_check(args, client=self.FailingClient())
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value)
+        output.should.match(r"Current Value: 12,")
+
+    def test_last_value_too_old(self, tmpdir, monkeypatch):
+        args = self.make_args(tmpdir, "last_value")
+        check_elasticsearch_metrics.run_check(args, client=StubElasticsearchClient(self.COMPLETE))
+
+        now = time.time()
+        monkeypatch.setattr(check_elasticsearch_metrics.time, "time", lambda: now + 3601)
+        alert_status, output = check_elasticsearch_metrics.run_check(args, client=StubElasticsearchClient(self.PARTIAL))
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value)
+        output.should.match(r"no recent last value")
+
+
+class TestCircuitBreaker:
+    COMPLETE = TestPartialResult.COMPLETE
+
+    class FailingClient:
+        def __init__(self):
+            self.requests = []
+
+        def search(self, **kwargs):
+            self.requests.append(kwargs)
+            raise elasticsearch.exceptions.ConnectionTimeout("TIMEOUT", "timed out", None)
+
+    @pytest.fixture
+    def now(self, monkeypatch):
+        now = [1516000000.0]
+        monkeypatch.setattr(check_elasticsearch_metrics.time, "time", lambda: now[0])
+        monkeypatch.setattr(check_elasticsearch_metrics.random, "uniform", lambda a, b: b)
+        return now
+
+    @staticmethod
+    def make_args(tmpdir, **kwargs):
+        defaults = dict(critical=10.0, warning=5.0, reverse=False, cache_dir=str(tmpdir),
+                        breaker_failures=2, breaker_slow_ms=None, breaker_backoff=30, breaker_max_backoff=600)
+        defaults.update(kwargs)
+        return TestExecuteElasticQuery.make_args(**defaults)
+
+    def test_opens_after_failures(self, tmpdir, now):
+        args = self.make_args(tmpdir)
+        client = self.FailingClient()
+
+        for _ in range(3):
+            alert_status, output = check_elasticsearch_metrics.run_check(args, client=client)
+            alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value)
+
+        client.requests.should.have.length_of(2)
+        output.should.be.equal("Circuit breaker open for test.me:9200, elasticsearch was not queried")
+
+    def test_index_pruning_goes_through_it(self, tmpdir, now):
+        args = check_elasticsearch_metrics.parse_args(["--host", "127.0.0.1", "--port", "1", "--cache_dir", str(tmpdir),
+                                                       "-s", "600", "-q", "*", "-c", "10", "-w", "5", "--fast_http",
+                                                       "--breaker_failures", "2"])
+
+        for _ in range(2):
+            alert_status, output = check_elasticsearch_metrics.run_check(args)
+            output.should.match(r"^Got elasticsearch exception: GET /_cat/indices/")
+
+        alert_status, output = check_elasticsearch_metrics.run_check(args)
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value)
+        output.should.be.equal("Circuit breaker open for 127.0.0.1:1, elasticsearch was not queried")
+
+    def test_client_errors_leave_it_closed(self, tmpdir, now):
+        class BadRequestClient:
+            def __init__(self, status_code):
+                self.status_code = status_code
+                self.requests = []
+
+            def search(self, **kwargs):
+                self.requests.append(kwargs)
+                raise elasticsearch.exceptions.TransportError(self.status_code, "search_phase_execution_exception", {})
+
+        args = self.make_args(tmpdir)
+        client = BadRequestClient(400)
+        for _ in range(3):
+            alert_status, output = check_elasticsearch_metrics.run_check(args, client=client)
+
+        client.requests.should.have.length_of(3)
+        output.should.match(r"^Got elasticsearch exception: .*400")
+
+        client = BadRequestClient(429)
+        for _ in range(3):
+            check_elasticsearch_metrics.run_check(args, client=client)
+
+        client.requests.should.have.length_of(2)
+
+    def test_half_open_probe(self, tmpdir, now):
+        args = self.make_args(tmpdir)
+        for _ in range(2):
+            check_elasticsearch_metrics.run_check(args, client=self.FailingClient())
+
+        now[0] += 30
+        check_elasticsearch_metrics.breaker_allows(args).should.be.equal(True)
+        # only one check probes at a time
+        check_elasticsearch_metrics.breaker_allows(args).should.be.equal(False)
+
+        now[0] += check_elasticsearch_metrics.BREAKER_PROBE_TIMEOUT
+        client = StubElasticsearchClient(self.COMPLETE)
+        alert_status, _ = check_elasticsearch_metrics.run_check(args, client=client)
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value)
+        client.requests.should.have.length_of(1)
+        check_elasticsearch_metrics.breaker_allows(args).should.be.equal(True)
+
+    def test_failed_probe_backs_off_longer(self, tmpdir, now):
+        args = self.make_args(tmpdir, breaker_max_backoff=100)
+        client = self.FailingClient()
+        for _ in range(2):
+            check_elasticsearch_metrics.run_check(args, client=client)
+
+        for backoff in (30, 60, 100):
+            now[0] += backoff - 1
+            check_elasticsearch_metrics.breaker_allows(args).should.be.equal(False)
+            now[0] += 1
+            check_elasticsearch_metrics.run_check(args, client=client)
+
+        client.requests.should.have.length_of(5)
+
+    def test_slow_responses(self, tmpdir, now):
+        args = self.make_args(tmpdir, breaker_slow_ms=1000)
+        client = StubElasticsearchClient(dict(self.COMPLETE, took=4000))
+
+        for _ in range(3):
+            check_elasticsearch_metrics.run_check(args, client=client)
+
+        client.requests.should.have.length_of(2)
+
+    def test_last_value_while_open(self, tmpdir, now):
+        args = self.make_args(tmpdir, partial_result="last_value")
+        check_elasticsearch_metrics.run_check(args, client=StubElasticsearchClient(self.COMPLETE))
+        for _ in range(2):
+            check_elasticsearch_metrics.run_check(args, client=self.FailingClient())
+
+        alert_status, output = check_elasticsearch_metrics.run_check(args, client=self.FailingClient())
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value)
+        output.should.match(r"Current Value: 12,")
+
+
+class TestMain:
+    @staticmethod
+    def run_main(es, tmpdir, *argv):
+        return run_main(*check_argv(es, tmpdir, "-c", "600", "-w", "300", "-s", "600", *argv))
+
+    def test_count(self, es, tmpdir, capsys):
+        self.run_main(es, tmpdir, "-q", "level:ERROR") \
+            .should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value)
+
+        capsys.readouterr().out.should.match(r"^Exited with: 2, Current Value: 1000, .* \| value=1000;300.0;600.0;; ")
+        es.requests.should.have.length_of(2)
+        es.requests[0][1].should.match(r"^/_cat/indices/")
+        es.requests[1][1].should.match(r"^/logstash-\d{4}\.\d{2}\.\d{2}/_search$")
+
+    def test_aggregation(self, es, tmpdir, capsys):
+        self.run_main(es, tmpdir, "-q", "*",
+                      "--aggregation_name", "levels",
+                      "--aggregation_type", "significant_terms",
+                      "--aggregation_field", "level.raw",
+                      "--aggregation_result_bucket_key", "key-1",
+                      "--aggregation_result_type", "percentage",
+                      "-c", "50", "-w", "20") \
+            .should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.WARNING.value)
+
+        capsys.readouterr().out.should.match(r"Current Value: 25.0,")
+
+    def test_missing_indices_not_searched(self, es, tmpdir):
+        es.indices = ["logstash-2018.01.13"]
+
+        self.run_main(es, tmpdir, "-q", "*", "-i", "3")
+
+        es.requests[0][1].should.match(r"^/_cat/indices/")
+        es.requests[1][1].should.match(r"^/logstash-\d{4}\.\d{2}\.\d{2}/_search$")
+
+    def test_fast_http(self, es, tmpdir, capsys):
+        es.indices = ["logstash-2018.01.13"]
+
+        self.run_main(es, tmpdir, "--fast_http", "-q", "*", "-i", "3",
+                      "--aggregation_name", "codes",
+                      "--aggregation_type", "terms",
+                      "--aggregation_field", "response",
+                      "--aggregation_result_bucket_key", "500..501",
+                      "--request_cache") \
+            .should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value)
+
+        capsys.readouterr().out.should.match(r"Current Value: 750,")
+        es.requests[0][1].should.match(r"^/_cat/indices/")
+        method, path, params, body = es.requests[1]
+        path.should.match(r"^/logstash-\d{4}\.\d{2}\.\d{2}/_search$")
+        params.should.be.equal({"request_cache": ["true"]})
+        json.loads(body)["aggs"].should.be.equal({"codes": {"terms": {"field": "response", "include": ["500", "501"], "size": 2}}})
+
+    def test_fast_http_does_not_import_elasticsearch(self, es, tmpdir):
+        code = "import sys, check_elasticsearch_metrics\n" \
+               "try:\n" \
+               "    check_elasticsearch_metrics.main(sys.argv[1:])\n" \
+               "finally:\n" \
+               "    print(sorted(m for m in sys.modules if m.split('.')[0] in ('elasticsearch', 'elasticsearch_dsl')))\n"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        output = subprocess.run([sys.executable, "-c", code, "--fast_http"] +
+                                check_argv(es, tmpdir, "-c", "600", "-w", "300", "-s", "600", "-q", "*"),
+                                cwd=root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode("utf-8")
+
+        output.splitlines()[-1].should.be.equal("[]")
+
+    def test_unreachable_cluster(self, es, tmpdir):
+        es.stop()
+
+        self.run_main(es, tmpdir, "-q", "*") \
+            .should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value)
+        es.start()
+
+
+class TestCompositeQuery:
+    @pytest.fixture
+    def stub_options(self):
+        return {"total": 1 << 20, "bucket_count": 25}
+
+    @staticmethod
+    def run_check(es, tmpdir, *argv):
+        args = check_elasticsearch_metrics.parse_args(check_argv(es, tmpdir, "-s", "600", "-q", "*", "-c", "600", "-w", "300",
+                                                                 "--aggregation_name", "hosts",
+                                                                 "--aggregation_type", "composite",
+                                                                 "--aggregation_field", "host.raw",
+                                                                 "--composite_page_size", "10", *argv))
+        return check_elasticsearch_metrics.run_check(args)
+
+    def test_pages_through_all_buckets(self, es, tmpdir):
+        status, output = self.run_check(es, tmpdir, "--fast_http", "--aggregation_result_bucket_key", "key-21")
+
+        output.should.match(r"Current Value: 1,.* es_took=3ms;")
+        bodies = [json.loads(body)["aggs"]["hosts"]["composite"] for method, path, params, body in searches(es)]
+        [body.get("after") for body in bodies].should.be.equal([None, {"hosts": "key-9"}, {"hosts": "key-19"}])
+        bodies[0]["sources"].should.be.equal([{"hosts": {"terms": {"field": "host.raw"}}}])
+
+    def test_pages_share_the_latency_budget(self, es, tmpdir):
+        # the cached _cat/indices lookup leaves the whole budget to the pages
+        self.run_check(es, tmpdir, "--fast_http", "--aggregation_result_bucket_key", "key-1")
+        es.requests = []
+        es.latency = 0.2
+
+        started = time.perf_counter()
+        status, output = self.run_check(es, tmpdir, "--fast_http", "--budget_ms", "300", "--aggregation_result_bucket_key", "key-1")
+
+        # the second page only got the last 100ms and timed out, the first page's buckets are a lower bound
+        (time.perf_counter() - started).should.be.lower_than(0.5)
+        output.should.match(r"Current Value: \d+,.* es_timed_out=1;")
+        json.loads(searches(es)[0][3])["timeout"].should.be.equal("225ms")
+        int(json.loads(searches(es)[1][3])["timeout"][:-2]).should.be.lower_than(100)
+
+    def test_raw_body_with_elasticsearch_py(self, es, tmpdir):
+        status, output = self.run_check(es, tmpdir, "--aggregation_result_type", "percentage")
+
+        status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.OK.value)
+        output.should.match(r"Current Value: 50.0,")
+        searches(es).should.have.length_of(3)
+
+    def test_incremental_not_supported(self):
+        with pytest.raises(SystemExit):
+            check_elasticsearch_metrics.parse_args(["--host", "test.me", "-s", "600", "-q", "*", "-c", "2", "-w", "1",
+                                                    "--aggregation_name", "hosts",
+                                                    "--aggregation_type", "composite",
+                                                    "--aggregation_field", "host.raw",
+                                                    "--incremental"])
+
+
+class TestPerBucket:
+    RESPONSE = {"took": 2,
+                "hits": {"total": 1000},
+                "aggregations": {"hosts": {"buckets": [{"key": "web-1", "doc_count": 700},
+                                                       {"key": "web 2", "doc_count": 200},
+                                                       {"key": "web-3", "doc_count": 100}]}}}
+
+    @staticmethod
+    def make_args(*argv):
+        return check_elasticsearch_metrics.parse_args(["--host", "test.me", "-s", "600", "-q", "*",
+                                                       "--aggregation_name", "hosts",
+                                                       "--aggregation_type", "terms",
+                                                       "--aggregation_field", "host.raw",
+                                                       "--per_bucket"] + list(argv))
+
+    def test_worst_bucket(self):
+        args = self.make_args("-c", "500", "-w", "150")
+
+        alert_status, output = check_elasticsearch_metrics.evaluate_response(args, self.RESPONSE)
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value)
+        status, perfdata = output.split(" | ")
+        status.should.be.equal("Exited with: 2, Current Value: 700, Critical: 500.0, Warning: 150.0, "
+                               "Buckets: web-1=700 (CRITICAL), web 2=200 (WARNING)")
+        perfdata.should.match(r"^value=700;150.0;500.0;; bucket_web-1=700;150.0;500.0;; "
+                              r"'bucket_web 2'=200;150.0;500.0;; bucket_web-3=100;150.0;500.0;; ")
+
+    def test_threshold_overrides(self):
+        args = self.make_args("-c", "500", "-w", "150", "--aggregation_result_type", "percentage",
+                              "--bucket_threshold", "web-1=80:90", "--bucket_threshold", "web-3=5:8")
+
+        alert_status, output = check_elasticsearch_metrics.evaluate_response(args, self.RESPONSE)
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value)
+        output.should.match(r"^Exited with: 2, Current Value: 10.0, .*, Buckets: web-3=10.0 \(CRITICAL\) \| ")
+        output.should.match(r" bucket_web-1=70.0;80.0;90.0;; ")
+
+    def test_requested_keys_only(self):
+        args = self.make_args("-c", "50", "-w", "100", "--reverse",
+                              "--aggregation_result_bucket_key", "web-1", "--aggregation_result_bucket_key", "web-4")
+
+        alert_status, output = check_elasticsearch_metrics.evaluate_response(args, self.RESPONSE)
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value)
+        output.should.match(r"Current Value: 0, .*, Buckets: web-4=0 \(CRITICAL\) \| value=0;100.0;50.0;; "
+                            r"bucket_web-1=700;100.0;50.0;; bucket_web-4=0;100.0;50.0;;")
+
+    def test_invalid_arguments(self):
+        with pytest.raises(SystemExit):
+            self.make_args("-c", "2", "-w", "1", "--bucket_threshold", "web-1=high")
+
+        with pytest.raises(SystemExit):
+            check_elasticsearch_metrics.parse_args(["--host", "test.me", "-s", "600", "-q", "*", "-c", "2", "-w", "1",
+                                                    "--per_bucket"])
+
+        with pytest.raises(SystemExit):
+            self.make_args("-c", "2", "-w", "1", "--reverse")
+
+    def test_all_buckets_requested(self):
+        args = self.make_args("-c", "2", "-w", "1", "--bucket_size", "500")
+
+        check_elasticsearch_metrics.build_aggregation(args).should.be.equal({"terms": {"field": "host.raw", "size": 500}})
+
+    def test_label_without_equals_sign(self):
+        check_elasticsearch_metrics.format_perfdata("bucket_a=b c", 1).should.be.equal("'bucket_a_b c'=1;;;;")
+        check_elasticsearch_metrics.format_perfdata("bucket_a=b", 1).should.be.equal("bucket_a_b=1;;;;")
+
+
+class TestMetricAggregation:
+    @staticmethod
+    def make_args(aggregation_type, *argv):
+        return check_elasticsearch_metrics.parse_args(["--host", "test.me", "-s", "600", "-q", "*",
+                                                       "--aggregation_name", "latency",
+                                                       "--aggregation_type", aggregation_type,
+                                                       "--aggregation_field", "request_time"] + list(argv))
+
+    def test_single_value(self):
+        args = self.make_args("avg", "-c", "500", "-w", "200")
+        response = {"hits": {"total": 10}, "aggregations": {"latency": {"value": 312.5}}}
+
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(312.5)
+        check_elasticsearch_metrics.build_request_body(args)["aggs"].should.be.equal(
+            {"latency": {"avg": {"field": "request_time"}}})
+
+    def test_percentiles(self):
+        args = self.make_args("percentiles", "-c", "500", "-w", "200",
+                              "--aggregation_result_bucket_key", "95", "--aggregation_result_bucket_key", "99.9")
+        response = {"hits": {"total": 10}, "aggregations": {"latency": {"values": {"95.0": 180.0, "99.9": 420.0}}}}
+
+        check_elasticsearch_metrics.build_request_body(args)["aggs"].should.be.equal(
+            {"latency": {"percentiles": {"field": "request_time", "percents": [95.0, 99.9]}}})
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(420.0)
+
+        args.reverse = True
+        check_elasticsearch_metrics.handle_elastic_response(args, response).should.be.equal(180.0)
+
+    def test_no_documents(self):
+        args = self.make_args("stats", "-c", "500", "-w", "200", "--aggregation_result_bucket_key", "max")
+        response = {"hits": {"total": 0},
+                    "aggregations": {"latency": {"count": 0, "min": None, "max": None, "avg": None, "sum": None}}}
+
+        alert_status, output = check_elasticsearch_metrics.evaluate_response(args, response)
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value)
+        output.should.be.equal("No stats value, no documents matched")
+
+    def test_invalid_arguments(self):
+        with pytest.raises(SystemExit):
+            self.make_args("percentiles", "-c", "2", "-w", "1")
+
+        with pytest.raises(SystemExit):
+            self.make_args("avg", "-c", "2", "-w", "1", "--aggregation_result_type", "percentage")
+
+    def test_invalid_bucket_keys(self):
+        with pytest.raises(SystemExit):
+            self.make_args("stats", "-c", "2", "-w", "1", "--aggregation_result_bucket_key", "p99")
+
+        with pytest.raises(SystemExit):
+            self.make_args("percentiles", "-c", "2", "-w", "1", "--aggregation_result_bucket_key", "p99")
+
+        with pytest.raises(SystemExit):
+            self.make_args("percentiles", "-c", "2", "-w", "1", "--aggregation_result_bucket_key", "101")
+
+    def test_stats_per_bucket(self, es, tmpdir):
+        args = self.make_args("stats", "-c", "900", "-w", "400", *check_argv(es, tmpdir), "--per_bucket",
+                              "--aggregation_result_bucket_key", "avg", "--aggregation_result_bucket_key", "max",
+                              "--bucket_threshold", "max=1500:2000")
+
+        alert_status, output = check_elasticsearch_metrics.run_check(args)
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.WARNING.value)
+        output.should.match(r"Current Value: 500.5, .*, Buckets: avg=500.5 \(WARNING\) \| value=500.5;400.0;900.0;; "
+                            r"bucket_avg=500.5;400.0;900.0;; bucket_max=1000.0;1500.0;2000.0;; ")
+
+    def test_percentiles_with_fast_http(self, es, tmpdir):
+        args = self.make_args("percentiles", "-c", "900", "-w", "400", *check_argv(es, tmpdir), "--fast_http",
+                              "--aggregation_result_bucket_key", "99")
+
+        alert_status, output = check_elasticsearch_metrics.run_check(args)
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value)
+        output.should.match(r"^Exited with: 2, Current Value: 990.0, ")
+
+
+class TestSampledAggregation:
+    @pytest.fixture
+    def stub_options(self):
+        return {"total": 1000000, "bucket_count": 3}
+
+    @staticmethod
+    def make_args(es, tmpdir, *argv):
+        return check_elasticsearch_metrics.parse_args(check_argv(es, tmpdir, "-s", "600", "-q", "*",
+                                                                 "-c", "600000", "-w", "300000",
+                                                                 "--aggregation_name", "levels",
+                                                                 "--aggregation_type", "terms",
+                                                                 "--aggregation_field", "level.raw",
+                                                                 "--aggregation_result_bucket_key", "key-1",
+                                                                 "--sample_size", "200", *argv))
+
+    def test_counts_are_scaled(self, es, tmpdir):
+        alert_status, output = check_elasticsearch_metrics.run_check(self.make_args(es, tmpdir))
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.WARNING.value)
+        # 500 of the 1000 sampled documents
+        output.should.match(r"Current Value: 500000, .* \| value=500000;300000.0;600000.0;; "
+                            r"sample_size=1000;;;; sample_of=1000000;;;; ")
+        json.loads(searches(es)[0][3])["aggs"].should.be.equal(
+            {"sample": {"sampler": {"shard_size": 200},
+                        "aggs": {"levels": {"terms": {"field": "level.raw", "include": ["key-1"], "size": 1}}}}})
+
+    def test_percentage_of_the_sample(self, es, tmpdir):
+        alert_status, output = check_elasticsearch_metrics.run_check(
+            self.make_args(es, tmpdir, "--aggregation_result_type", "percentage", "--fast_http",
+                           "--sample_diversify_field", "host.raw"))
+
+        output.should.match(r"Current Value: 50.0, ")
+        json.loads(searches(es)[0][3])["aggs"]["sample"]["diversified_sampler"].should.be.equal(
+            {"shard_size": 200, "field": "host.raw"})
+
+    def test_sum_is_scaled(self):
+        args = check_elasticsearch_metrics.parse_args(["--host", "test.me", "-s", "600", "-q", "*", "-c", "2", "-w", "1",
+                                                       "--aggregation_name", "bytes",
+                                                       "--aggregation_type", "stats",
+                                                       "--aggregation_field", "bytes",
+                                                       "--aggregation_result_bucket_key", "sum",
+                                                       "--aggregation_result_bucket_key", "avg",
+                                                       "--sample_size", "100", "--per_bucket"])
+        response = {"hits": {"total": 4000},
+                    "aggregations": {"sample": {"doc_count": 500,
+                                                "bytes": {"count": 500, "min": 1, "max": 10, "avg": 2.5, "sum": 1250.0}}}}
+
+        check_elasticsearch_metrics.handle_bucket_values(args, response).should.be.equal([("sum", 10000.0), ("avg", 2.5)])
+
+    def test_requires_an_aggregation(self):
+        with pytest.raises(SystemExit):
+            check_elasticsearch_metrics.parse_args(["--host", "test.me", "-s", "600", "-q", "*", "-c", "2", "-w", "1",
+                                                    "--sample_size", "100"])
+
+
+class TestProfile:
+    @staticmethod
+    def make_args(es, tmpdir, *argv):
+        return check_elasticsearch_metrics.parse_args(check_argv(es, tmpdir, "-s", "600", "-q", "level:ERROR",
+                                                                 "-c", "2", "-w", "1", "--fast_http", "--profile",
+                                                                 "--profile_top", "2", *argv))
+
+    def test_report(self, es, tmpdir):
+        alert_status, output = check_elasticsearch_metrics.run_profile(self.make_args(es, tmpdir))
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.OK.value)
+        lines = output.splitlines()
+        lines[0].should.match(r"^Profile of the check search on logstash-")
+        lines[1:].should.be.equal([
+            "slowest shards:",
+            "       5.001 ms  [stub][logstash-2018.01.15][4]",
+            "       4.001 ms  [stub][logstash-2018.01.15][3]",
+            "query components:",
+            "      15.000 ms  BooleanQuery: +level:error #@timestamp:[1516000000000 TO *]",
+            "       1.500 ms  TermQuery: level:error",
+            "collectors:",
+            "       7.500 ms  CancellableCollector (search_cancelled)",
+            "       3.750 ms  TotalHitCountCollector (search_count)",
+        ])
+        json.loads(searches(es)[0][3])["profile"].should.be.equal(True)
+
+    def test_compare_variants(self, es, tmpdir):
+        alert_status, output = check_elasticsearch_metrics.run_profile(self.make_args(
+            es, tmpdir, "--profile_compare",
+            "--aggregation_name", "levels", "--aggregation_type", "terms", "--aggregation_field", "level.raw"))
+
+        output.should.match(r"aggregations:\n      30.000 ms  GlobalOrdinalsStringTermsAggregator: levels\n")
+        output.should.match(r"comparison:\n  check +took +1 ms, .*\n  count only +took .*\n  scored, 10 hits +took .*$")
+        bodies = [json.loads(body) for method, path, params, body in searches(es)]
+        [("aggs" in body, body["size"]) for body in bodies].should.be.equal([(True, 0), (False, 0), (True, 10)])
+        bodies[2]["query"]["bool"]["must"].should.be.equal([{"query_string": {"query": "level:ERROR", "analyze_wildcard": True}}])
+
+    def test_human_readable_times(self):
+        check_elasticsearch_metrics.profile_nanos({"time": "1.5ms"}).should.be.equal(1500000)
+        check_elasticsearch_metrics.profile_nanos({"time": "20micros"}).should.be.equal(20000)
+
+
+class TestSearchTemplate:
+    @staticmethod
+    def make_args(es, tmpdir, *argv):
+        return check_elasticsearch_metrics.parse_args(check_argv(es, tmpdir, "-s", "600", "-q", "level:ERROR",
+                                                                 "-c", "600", "-w", "300", "--template", "errors",
+                                                                 "--aggregation_name", "levels",
+                                                                 "--aggregation_type", "significant_terms",
+                                                                 "--aggregation_field", "level.raw",
+                                                                 "--aggregation_result_bucket_key", "key-1", *argv))
+
+    def test_template_source(self, es, tmpdir):
+        args = self.make_args(es, tmpdir, "--time_rounding", "m")
+
+        body = json.loads(check_elasticsearch_metrics.build_template_source(args))
+        body["query"]["bool"]["filter"][1].should.be.equal({"range": {"@timestamp": {"gte": "{{from}}"}}})
+        check_elasticsearch_metrics.build_template_request(args).should.be.equal({"id": "errors",
+                                                                                  "params": {"from": "now-600s/m"}})
+
+    @pytest.mark.parametrize("fast_http", [True, False])
+    def test_store_and_search(self, es, tmpdir, fast_http):
+        argv = ["--fast_http"] if fast_http else []
+
+        alert_status, output = check_elasticsearch_metrics.store_template(self.make_args(es, tmpdir, "--store_template", *argv))
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.OK.value)
+        es.requests[-1][:2].should.be.equal(("PUT", "/_scripts/errors"))
+
+        alert_status, output = check_elasticsearch_metrics.run_check(self.make_args(es, tmpdir, *argv))
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.OK.value)
+        output.should.match(r"Current Value: 250,")
+        method, path, params, body = es.requests[-1]
+        path.should.match(r"/_search/template$")
+        json.loads(body).should.be.equal({"id": "errors", "params": {"from": "now-600s"}})
+
+    def test_missing_template(self, es, tmpdir):
+        alert_status, output = check_elasticsearch_metrics.run_check(self.make_args(es, tmpdir, "--fast_http"))
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.UNKNOWN.value)
+        output.should.match(r"resource_not_found_exception")
+
+
+class TestBaseline:
+    NOW = 1516000030.0
+
+    class MultiSearchClient:
+        def __init__(self, totals):
+            self.totals = totals
+            self.requests = []
+
+        def msearch(self, body, **params):
+            self.requests.append(body)
+            return {"responses": [{"took": 1, "hits": {"total": total, "hits": []}}
+                                  for total in self.totals[:len(body) // 2]]}
+
+    @pytest.fixture
+    def now(self, monkeypatch):
+        monkeypatch.setattr(check_elasticsearch_metrics.time, "time", lambda: self.NOW)
+
+    @staticmethod
+    def make_args(tmpdir, *argv):
+        # MultiSearchClient only answers _msearch, the indices aren't pruned
+        return check_elasticsearch_metrics.parse_args(["--host", "test.me", "--cache_dir", str(tmpdir), "--index_cache_ttl", "0",
+                                                       "-s", "600", "-q", "*", "-c", "3", "-w", "1.5"] + list(argv))
+
+    def test_one_msearch_then_cached(self, es, tmpdir, now):
+        args = check_elasticsearch_metrics.parse_args(check_argv(es, tmpdir, "-s", "600", "-q", "*", "-c", "3", "-w", "1.5",
+                                                                 "--fast_http", "--baseline", "previous",
+                                                                 "--baseline", "yesterday"))
+
+        for _ in range(2):
+            alert_status, output = check_elasticsearch_metrics.run_check(args)
+            alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.OK.value)
+
+        output.should.match(r"^Exited with: 0, Current Value: 1.0, .*, Current: 1000, Baseline: 1000.0 "
+                            r"\(previous=1000.0, yesterday=1000.0\) \| value=1.0;1.5;3.0;; current=1000;;;; "
+                            r"baseline_previous=1000.0;;;; baseline_yesterday=1000.0;;;; ")
+        [path for method, path, params, body in searches(es)].should.be.equal(["/_msearch", "/_msearch"])
+
+        first, second = [[json.loads(line) for line in body.splitlines()] for method, path, params, body in searches(es)]
+        first.should.have.length_of(6)
+        first[1]["query"]["bool"]["filter"][1]["range"]["@timestamp"].should.be.equal({"gte": "now-600s"})
+        first[3]["query"]["bool"]["filter"][1]["range"]["@timestamp"].should.be.equal(
+            {"gte": 1515998820000, "lt": 1515999420000, "format": "epoch_millis"})
+        first[5]["query"]["bool"]["filter"][1]["range"]["@timestamp"].should.be.equal(
+            {"gte": 1515913020000, "lt": 1515913620000, "format": "epoch_millis"})
+        first[2]["ignore_unavailable"].should.be.equal(True)
+        first[4]["index"].should.be.equal("logstash-2018.01.14")
+        second.should.have.length_of(2)
+
+    def test_ratio_and_delta(self, tmpdir, now):
+        client = self.MultiSearchClient([300, 100, 200])
+        args = self.make_args(tmpdir, "--baseline", "yesterday", "--baseline", "last_week")
+
+        alert_status, output = check_elasticsearch_metrics.run_check(args, client=client)
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.WARNING.value)
+        output.should.match(r"Current Value: 2.0, .*, Current: 300, Baseline: 150.0 \(yesterday=100.0, last_week=200.0\)")
+
+        args = self.make_args(tmpdir, "--baseline", "yesterday", "--baseline", "last_week", "--baseline_compare", "delta",
+                              "-c", "200", "-w", "100")
+        alert_status, output = check_elasticsearch_metrics.run_check(args, client=client)
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.WARNING.value)
+        output.should.match(r"Current Value: 150.0, ")
+        # both baselines came from the cache
+        client.requests[-1].should.have.length_of(2)
+
+    def test_counts_scaled_to_the_current_window(self, tmpdir, now):
+        # the current window starts at the rounded now-600s, 610 seconds ago, the baseline windows last 600 seconds
+        client = self.MultiSearchClient([244, 240])
+        args = self.make_args(tmpdir, "--baseline", "previous", "--time_rounding", "m")
+
+        alert_status, output = check_elasticsearch_metrics.run_check(args, client=client)
+
+        output.should.match(r"Current Value: 1.0, .*, Current: 244, Baseline: 244.0 ")
+
+    def test_deleted_indices_are_no_baseline(self, tmpdir, now):
+        client = self.MultiSearchClient([300, 100, 0])
+        msearch = client.msearch
+
+        def deleted_last_week(body, **params):
+            response = msearch(body, **params)
+            response["responses"][-1]["_shards"] = {"total": 0, "successful": 0, "failed": 0}
+            return response
+
+        client.msearch = deleted_last_week
+        args = self.make_args(tmpdir, "--baseline", "yesterday", "--baseline", "last_week")
+
+        alert_status, output = check_elasticsearch_metrics.run_check(args, client=client)
+
+        alert_status.should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.CRITICAL.value)
+        output.should.match(r"Current Value: 3.0, .*, Current: 300, Baseline: 100.0 \(yesterday=100.0, last_week=none\) "
+                            r"\| .* baseline_last_week=U;;;;")
+
+    def test_invalid_arguments(self, tmpdir):
+        with pytest.raises(SystemExit):
+            self.make_args(tmpdir, "--baseline", "previous", "--incremental")
+
+        with pytest.raises(SystemExit):
+            self.make_args(tmpdir, "--baseline", "previous", "--time_rounding", "h")
+
+        with pytest.raises(SystemExit):
+            self.make_args(tmpdir, "--baseline", "previous", "-s", "90")
+
+    def test_windows_keep_their_length(self):
+        args = check_elasticsearch_metrics.parse_args(["--host", "test.me", "-s", "120", "-q", "*", "-c", "3", "-w", "1.5",
+                                                       "--baseline", "previous"])
+
+        for now in (self.NOW, self.NOW + 30, self.NOW + 59):
+            windows, scale = check_elasticsearch_metrics.baseline_windows(args, now)
+            start, end = windows["previous"]
+            (end - start).should.be.equal(120000)
+            scale.should.be.equal(1.0)
+
+
+class TestResultCache:
+    @staticmethod
+    def run_main(es, tmpdir, *argv):
+        return run_main(*check_argv(es, tmpdir, "-s", "600", "-q", "*",
+                                    "--aggregation_name", "levels",
+                                    "--aggregation_type", "significant_terms",
+                                    "--aggregation_field", "level.raw", *argv))
+
+    def test_variants_share_one_search(self, es, tmpdir, capsys):
+        self.run_main(es, tmpdir, "--result_cache_ttl", "30", "--aggregation_result_bucket_key", "key-0",
+                      "-c", "600", "-w", "300") \
+            .should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.WARNING.value)
+        self.run_main(es, tmpdir, "--result_cache_ttl", "30", "--aggregation_result_bucket_key", "key-1",
+                      "-c", "400", "-w", "200") \
+            .should.be.equal(check_elasticsearch_metrics.NagiosReturnCodes.WARNING.value)
+
+        capsys.readouterr().out.should.match(r"Current Value: 500,(.|\n)*Current Value: 250,")
+        searches(es).should.have.length_of(1)
+
+    def test_disabled_by_default(self, es, tmpdir):
+        self.run_main(es, tmpdir, "--aggregation_result_bucket_key", "key-0", "-c", "600", "-w", "300")
+        self.run_main(es, tmpdir, "--aggregation_result_bucket_key", "key-0", "-c", "600", "-w", "300")
+
+        searches(es).should.have.length_of(2)
+        [name for name in os.listdir(str(tmpdir)) if name.startswith("result-")].should.be.equal([])
+
+    def test_expired(self, es, tmpdir, monkeypatch):
+        self.run_main(es, tmpdir, "--result_cache_ttl", "30", "--aggregation_result_bucket_key", "key-0",
+                      "-c", "600", "-w", "300")
+
+        now = time.time()
+        monkeypatch.setattr(check_elasticsearch_metrics.time, "time", lambda: now + 30)
+        self.run_main(es, tmpdir, "--result_cache_ttl", "30", "--aggregation_result_bucket_key", "key-0",
+                      "-c", "600", "-w", "300")
+
+        searches(es).should.have.length_of(2)
+
+    def test_size_bound(self, es, tmpdir):
+        for seconds in ("600", "900", "1200"):
+            self.run_main(es, tmpdir, "--result_cache_ttl", "30", "--result_cache_size", "2", "-s", seconds,
+                          "--aggregation_result_bucket_key", "key-0", "-c", "600", "-w", "300")
+
+        [name for name in os.listdir(str(tmpdir)) if name.startswith("result-")].should.have.length_of(2)
+
+    def test_partial_response_not_cached(self, es, tmpdir):
+        es.recorded["_search"] = {"took": 1, "timed_out": True, "_shards": {"total": 5, "successful": 5, "failed": 0},
+                                  "hits": {"total": 10, "hits": []}}
+
+        for _ in range(2):
+            check_elasticsearch_metrics.run_check(check_elasticsearch_metrics.parse_args(
+                check_argv(es, tmpdir, "--fast_http", "--result_cache_ttl", "30", "-s", "600", "-q", "*", "-c", "600", "-w", "300")))
+
+        searches(es).should.have.length_of(2)
+
+
 # class TestCheckExitCode:
 #     def test(self):
 #         assert 0